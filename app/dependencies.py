@@ -1,22 +1,153 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import lru_cache
+
+import google.auth
+import httpx
+from google import genai
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from google.genai.types import HttpOptions
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from requests.adapters import HTTPAdapter
 
 class Settings(BaseSettings):
     MAX_THREADS: int = 5 #Max threads for executing parallel tasks
     region: str
     project_id: str
+    gcs_transfer_workers: int = 32 # Threads dedicated to GCS transfers, this is also the max of concurrent downloads
+    genai_max_connections: int = 100 # Max open connections of the shared genai client
+    genai_max_keepalive_connections: int = 50 # Idle connections kept open between gemini calls
+    genai_keepalive_expiry: float = 60 # Seconds an idle connection is kept open
+    warmup_gs_path: str | None = None # gs path listed at startup to get the storage token and connections ready
+    list_page_size: int = 100 # Blobs requested per page when listing a gs path
+    max_files_in_flight: int = 300 # Listed files waiting or being processed, the listing stops while the window is full
+    zip_in_memory: bool = False # Feed the zip members directly to the pipeline instead of flattening them in the bucket
+    zip_persist_members: bool = False # Only with zip_in_memory, upload the members to the bucket in background
+    zip_spool_max_size: int = 32 * 1024 * 1024 # Zips bigger than this are spooled to disk while being expanded
+    zip_max_members_in_memory: int = 10 # Max decompressed zip members waiting or being processed at the same time
+    gemini_max_concurrency: int = 50 # Files being sent to gemini at the same time, across every load of the instance
+    max_concurrent_loads: int = 4 # Loads of the /process endpoint running at the same time, the rest wait queued
+    extract_cache_size: int = 256 # Results of /extract kept in memory
+    extract_cache_ttl: float = 24 * 60 * 60 # Seconds a cached /extract result is valid, in memory and on disk
+    extract_cache_dir: str | None = None # Directory to also keep the /extract results on disk
+    extract_cache_disk_max_bytes: int = 256 * 1024 * 1024 # Size of the disk cache, the least used results are deleted
+    blob_cache_dir: str | None = None # Directory (eg in /tmp or a volume) to keep the downloaded files, not cached if not set
+    blob_cache_max_bytes: int = 2 * 1024 * 1024 * 1024 # Size of the downloaded files cache, the least used files are deleted
+    preflight: bool = True # Inspect the header and trailer of each file before downloading it, the bad ones are rejected
+    preflight_reject_encrypted: bool = False # Reject every encrypted pdf, also the ones with only an owner password that gemini reads, the inspection can't tell them apart
+    preflight_max_pages: int | None = None # Reject the pdfs with more pages, when their page count can be estimated
+    optimize_payloads: bool = False # Downscale the images of big pdfs and photos before gemini, needs pillow and pymupdf installed
+    optimize_min_size: int = 2 * 1024 * 1024 # Only files bigger than this are optimized
+    optimize_max_dpi: int = 150 # Images above this resolution are downscaled to it
+    optimize_jpeg_quality: int = 80 # Quality the downscaled images are re-encoded with
+    optimize_workers: int = 2 # Processes optimizing files, it is cpu bound work
+    cascade: bool = False # Extract with the fast model first, and with the stronger one only when the score is under the doc type threshold
     __hash__ = object.__hash__
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 class RMQSettings(BaseSettings):
-    rmq_user: str = "guest",
-    rmq_pass: str = "guest",
+    rmq_user: str = "guest"
+    rmq_pass: str = "guest"
     rmq_host: str
     rmq_port: int = 5672
-    rmq_max_tasks: int = 7
+    rmq_max_tasks: int = 7 # Messages processed at the same time by the worker, across every tenant
+    rmq_prefetch: int = 20 # Messages the broker hands to the worker before their ack, the scheduler picks between them
+    rmq_tenant_max_tasks: int = 3 # Messages of the same tenant processed at the same time
+    rmq_tenant_weights: dict[str, int] = {} # Slots in a row for a tenant on each round, 1 if not set
+    rmq_max_priority: int | None = None # Declares the queues with x-max-priority, a queue already declared without it has to be recreated
+    rmq_drain_timeout: float = 7 # Seconds the files in progress have to end when the instance is stopped
+    rmq_fan_out: bool = False # Publish one process.file message per file of a load instead of processing it in one handler
+    rmq_stream_results: bool = False # Publish the results to entity.store in batches as the files end, not one message per load
+    rmq_publish_batch_size: int = 20 # Results per entity.store message when streaming
+    rmq_publish_batch_window: float = 2 # Seconds a batch waits to be filled before being published anyway
+    rmq_publish_max_in_flight: int = 10 # Messages published waiting for their confirm at the same time
+    rmq_publish_max_retries: int = 5 # Retries of a publish rejected or failed by the broker
+    rmq_retry_max_attempts: int = 4 # Retries of a file that failed for a transient error before the dead letter queue
+    rmq_retry_base_delay: float = 10 # Seconds before the first retry of a file, doubled on every attempt
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 
 @lru_cache()
 def get_settings():
     return Settings()
+
+
+@lru_cache()
+def get_transfer_executor():
+    """
+    The gcs client is blocking, so every transfer takes a thread. This pool is only for them
+    and sized from the settings, the default executor of the loop would cap them silently
+    """
+    return ThreadPoolExecutor(max_workers=get_settings().gcs_transfer_workers, thread_name_prefix="gcs-transfer")
+
+
+@lru_cache()
+def get_optimize_executor():
+    """
+    The payload optimization is cpu bound, it runs in its own processes instead of holding the GIL of
+    the app. They are spawned (not forked from a process with running threads) when the first file is optimized
+    """
+    return ProcessPoolExecutor(max_workers=get_settings().optimize_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+@lru_cache()
+def get_download_limit():
+    """
+    Downloads in progress across every load, they can't be more than the transfer threads anyway.
+    Like the other process wide limits it is only used from the app loop
+    """
+    return asyncio.Semaphore(get_settings().gcs_transfer_workers)
+
+
+@lru_cache()
+def get_gemini_limit():
+    """
+    Files being processed by gemini across every load, so the quota is shared by the loads
+    instead of each load bringing its own limit
+    """
+    return asyncio.Semaphore(get_settings().gemini_max_concurrency)
+
+
+@lru_cache()
+def get_storage_client():
+    """
+    Process wide gcs client created in the app lifespan, building one per message means
+    loading the credentials and opening new connections every time. Its http pool is as big
+    as the transfer executor so every transfer thread can keep a connection alive
+    """
+    settings = get_settings()
+    credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=settings.gcs_transfer_workers, pool_maxsize=settings.gcs_transfer_workers)
+    session.mount("https://", adapter)
+    return storage.Client(project=settings.project_id, credentials=credentials, _http=session)
+
+
+@lru_cache()
+def get_genai_client():
+    """
+    Process wide genai client created in the app lifespan, a new client per request or message
+    loads the credentials again and opens cold connections to vertex. Limits and keep alive of
+    its http pool come from the settings
+    """
+    settings = get_settings()
+    limits = httpx.Limits(
+        max_connections=settings.genai_max_connections,
+        max_keepalive_connections=settings.genai_max_keepalive_connections,
+        keepalive_expiry=settings.genai_keepalive_expiry
+    )
+    http_options = HttpOptions(client_args={"limits": limits}, async_client_args={"limits": limits})
+    return genai.Client(vertexai=True, project=settings.project_id, location=settings.region, http_options=http_options)
+
+
+async def close_genai_client():
+    client = get_genai_client()
+    if hasattr(client.aio, "aclose"):
+        await client.aio.aclose()
+        client.close()
+        return
+    # Older google-genai versions don't expose a way to close the client, close its httpx clients
+    await client._api_client._async_httpx_client.aclose()
+    client._api_client._httpx_client.close()
@@ -0,0 +1,26 @@
+import uuid
+
+from pydantic import BaseModel
+
+
+class ObjectFinalized(BaseModel):
+    """
+    Object resource of a gcs OBJECT_FINALIZE notification (JSON_API_V1 payload), only the fields
+    used here. Whatever bridges the notifications to rabbit publishes it unchanged
+    """
+    bucket: str
+    name: str
+    size: int # gcs sends it as a string
+    generation: str | None = None
+
+    @property
+    def gs_path(self):
+        return f"gs://{self.bucket}/{self.name}"
+
+
+class LoadClose(BaseModel):
+    """
+    Sent by the orchestrator when the upload of an ingested load ended
+    """
+    load_id: uuid.UUID
+    files: int | None = None # objects uploaded, the load waits for all their notifications before closing
@@ -0,0 +1,33 @@
+import uuid
+from datetime import datetime
+from typing import Literal
+
+from pydantic import BaseModel, computed_field
+
+
+class FileProgress(BaseModel):
+    status: str # QUEUED, DOWNLOADING, PROCESSING or the status of its log once it ends
+    queued_at: datetime
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+
+
+class LoadJob(BaseModel):
+    """
+    State of a load sent to the /process endpoint, kept in memory while the instance lives
+    """
+    load_id: uuid.UUID
+    status: Literal['QUEUED', 'RUNNING', 'DONE', 'FAILED', 'CANCELLED'] = 'QUEUED'
+    queued_at: datetime
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+    files: dict[str, FileProgress] = {} # by blob name
+    result: str | None = None # where the results can be fetched once it ends
+
+    @computed_field
+    @property
+    def counts(self) -> dict[str, int]:
+        counts = {}
+        for file in self.files.values():
+            counts[file.status] = counts.get(file.status, 0) + 1
+        return counts
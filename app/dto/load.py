@@ -0,0 +1,19 @@
+import uuid
+from typing import Literal
+
+from pydantic import BaseModel
+
+from app.dto.entity_store import EntityStore
+
+
+class LoadEvent(BaseModel):
+    """
+    Progress of a fanned out load sent to the aggregator:
+    - listed: the init handler finished listing, files is the number of files published
+    - file_done: a file was processed, result is what is published to entity.store for it
+    """
+    load_id: uuid.UUID
+    kind: Literal['listed', 'file_done']
+    files: int | None = None
+    gs_path: str | None = None # file of the result, redelivered files are only counted once
+    result: EntityStore | None = None
@@ -9,10 +9,33 @@ class ProcessRequest(BaseModel):
     load_id: uuid.UUID # Process id sent by the broker
     gs_path: str # valid storage path
     doc_type: DocType
+    done_files: list[str] = [] # Blobs already processed, set when the load is sent again after a drain
 
     @field_validator('gs_path', mode="after")
     @classmethod
     def validate_gs_path(cls, v: str):
         if not v.startswith("gs://"):
             raise ValueError("gs_path is not a valid gcp bucket path")
-        return v
\ No newline at end of file
+        return v
+
+
+class ProcessFileRequest(BaseModel):
+    """
+    A single file of a load, published by the init handler when the load is fanned out
+    so any worker can process it
+    """
+    load_id: uuid.UUID
+    gs_path: str # gs path of the blob eg gs://bucket/folder/file.pdf
+    doc_type: DocType
+
+    @field_validator('gs_path', mode="after")
+    @classmethod
+    def validate_gs_path(cls, v: str):
+        return ProcessRequest.validate_gs_path(v)
+
+
+class CancelRequest(BaseModel):
+    """
+    Cancels a load in every instance, published to process.cancel
+    """
+    load_id: uuid.UUID
@@ -3,11 +3,34 @@ from contextlib import contextmanager, asynccontextmanager
 
 from fastapi import FastAPI
 
+from app.dependencies import get_storage_client, get_transfer_executor, get_genai_client, close_genai_client, \
+    get_optimize_executor
 from app.worker.broker import rmq_router
 from app.routers.extract import extract_info_router
 from app.routers.process import process_router
+from app.services.job_manager import get_job_manager
+from app.utils.blob_cache import get_blob_cache
+from app.utils.warmup import warm_up
 
-app = FastAPI(title="Bloocheck-api")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Process wide clients, created once here and shared by every request and message
+    get_storage_client()
+    get_genai_client()
+    # Indexes the cached files left by a previous run before the first download
+    get_blob_cache()
+    await warm_up()
+    yield
+    # The broker lifespan (included router) ends before this one, nothing is consuming anymore
+    await get_job_manager().shutdown()
+    get_storage_client().close()
+    await close_genai_client()
+    get_transfer_executor().shutdown(wait=True)
+    get_optimize_executor().shutdown(wait=True, cancel_futures=True)
+
+
+app = FastAPI(title="Bloocheck-api", lifespan=lifespan)
 
 app.include_router(rmq_router)
 app.include_router(process_router)
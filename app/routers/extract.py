@@ -1,34 +1,225 @@
-from typing import Annotated
+import asyncio
+import json
+import logging
+from typing import Annotated, Any, AsyncIterator
 
-#import magic
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from fastapi.params import Depends
+from fastapi.responses import StreamingResponse
 from google.genai.types import Part
+from pydantic import TypeAdapter, ValidationError
 
+from app.dependencies import get_gemini_limit
 from app.dto.process import DocType
-from app.services.model_service import ModelService, get_model_service
+from app.services.extract_cache import ExtractCache, get_extract_cache
+from app.services.model_service import ModelService, get_model_service, extraction_version
+from app.utils.single_flight import SingleFlight
+from app.utils.upload import receive_upload, receive_uploads, SpooledUpload
 
+logger = logging.getLogger("uvicorn.error")
 extract_info_router = APIRouter(prefix="/api/v1")
 MAX_FILE_SIZE = 10 * 1024 * 1024
+MAX_BATCH_FILES = 20
+PDF_SIGNATURE = b"%PDF-"
+# The same document requested again while it is being extracted waits for that extraction
+extractions = SingleFlight()
+# The form is parsed while it is uploaded, so it is documented here instead of by the parameters
+EXTRACT_FORM = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file", "doc_type"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary", "contentMediaType": "application/pdf"},
+                        "doc_type": {"type": "string", "enum": list(DocType.__args__)},
+                    },
+                },
+            },
+        },
+    },
+    "responses": {"200": {"content": {"application/json": {}, "text/event-stream": {}}}},
+}
+EXTRACT_BATCH_FORM = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["files", "doc_type"],
+                    "properties": {
+                        "files": {
+                            "type": "array",
+                            "maxItems": MAX_BATCH_FILES,
+                            "items": {"type": "string", "format": "binary", "contentMediaType": "application/pdf"},
+                        },
+                        "doc_type": {"type": "string", "enum": list(DocType.__args__)},
+                    },
+                },
+            },
+        },
+    },
+    "responses": {"200": {"content": {"application/x-ndjson": {}}}},
+}
 
-@extract_info_router.post("/extract")
+@extract_info_router.post("/extract", openapi_extra=EXTRACT_FORM)
 async def extract_info_from_doc(
         model_service: Annotated[ModelService, Depends(get_model_service)],
-        file: UploadFile = File(media_type="application/pdf"),
-        doc_type: DocType = Form(...)
+        cache: Annotated[ExtractCache, Depends(get_extract_cache)],
+        request: Request,
+        response: Response
 ):
-    if file.size > MAX_FILE_SIZE:
-        raise HTTPException(status_code=422, detail=f"File too large, MAX: {MAX_FILE_SIZE/100000} MB")
+    """
+    Results are cached by document, X-Cache tells if the result was cached (HIT, with the tier in
+    X-Cache-Tier), extracted for this request (MISS) or for an identical one in progress (SHARED).
+    Asking for text/event-stream the result is sent progressively: a data event as soon as the
+    extraction is ready and a score_info event when the audit finishes (or an error event)
+    """
+    progressive = "text/event-stream" in request.headers.get("accept", "")
+    upload = await receive_upload(request, "file", MAX_FILE_SIZE, PDF_SIGNATURE, "application/pdf")
+    try:
+        doc_type = parse_doc_type(upload.fields)
+        if progressive:
+            # Up to the data the errors are still sent as the status of the response
+            events = extraction_events(model_service, cache, upload, doc_type)
+            _, (status, tier) = await anext(events)
+            data = await anext(events)
+        else:
+            extracted, status, tier = await cached_extraction(model_service, cache, upload, doc_type)
+    finally:
+        upload.close()
+    headers = {"X-Cache": status}
+    if tier:
+        headers["X-Cache-Tier"] = tier
+    if progressive:
+        headers["Cache-Control"] = "no-cache"
+        return StreamingResponse(server_sent_events(data, events), media_type="text/event-stream", headers=headers)
+    response.headers.update(headers)
+    # Publish to rabbit if flag
+    return extracted
+
+
+@extract_info_router.post("/extract/batch", openapi_extra=EXTRACT_BATCH_FORM)
+async def extract_info_from_docs(
+        model_service: Annotated[ModelService, Depends(get_model_service)],
+        cache: Annotated[ExtractCache, Depends(get_extract_cache)],
+        request: Request
+):
+    """
+    Extracts up to MAX_BATCH_FILES documents of the same doc_type at the same time, streaming a json
+    line per document as soon as it finishes (in that order, index is its position in the form).
+    Each line has the status of its document and its result, or the detail of the error
+    """
+    uploads, fields = await receive_uploads(request, "files", MAX_FILE_SIZE, PDF_SIGNATURE, "application/pdf", MAX_BATCH_FILES)
+    try:
+        doc_type = parse_doc_type(fields)
+    except HTTPException:
+        for upload in uploads:
+            upload.close()
+        raise
+    return StreamingResponse(stream_extractions(model_service, cache, uploads, doc_type), media_type="application/x-ndjson")
+
+
+async def stream_extractions(model_service: ModelService, cache: ExtractCache, uploads: list[SpooledUpload], doc_type: DocType):
+    async def run(index: int, upload: SpooledUpload) -> dict[str, Any]:
+        line = {"index": index, "filename": upload.filename}
+        try:
+            extracted, status, tier = await cached_extraction(model_service, cache, upload, doc_type)
+            line.update(status=200, cache=status, cache_tier=tier, result=extracted)
+        except HTTPException as e:
+            line.update(status=e.status_code, detail=e.detail)
+        except Exception:
+            logger.exception(f"Error extracting {upload.filename} of a batch")
+            line.update(status=500, detail="Internal Server Error")
+        finally:
+            upload.close()
+        return line
+
+    # The gemini calls are bounded by the process wide limit, not by the size of the batch
+    tasks = [asyncio.create_task(run(index, upload)) for index, upload in enumerate(uploads)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield json.dumps(await finished, ensure_ascii=False, default=str) + "\n"
+    finally:
+        # The client went away, the documents left are not extracted
+        for task in tasks:
+            task.cancel()
+        for upload in uploads:
+            upload.close()
+
+
+async def server_sent_events(data: tuple[str, Any], events: AsyncIterator[tuple[str, Any]]):
+    def event(name: str, value: Any) -> str:
+        return f"event: {name}\ndata: {json.dumps(value, ensure_ascii=False, default=str)}\n\n"
 
-    buffer = await file.read()
-    if not magic.from_buffer(buffer, mime=True) == 'application/pdf':
-        raise HTTPException(status_code=422, detail=f"File must be a valid pdf")
+    try:
+        yield event(*data)
+        async for name, value in events:
+            yield event(name, value)
+    except HTTPException as e:
+        yield event("error", {"status": e.status_code, "detail": e.detail})
+    except Exception:
+        logger.exception("Error auditing a progressive extraction")
+        yield event("error", {"status": 500, "detail": "Internal Server Error"})
+    finally:
+        await events.aclose()
 
+
+def parse_doc_type(fields: dict[str, str]) -> DocType:
+    try:
+        return TypeAdapter(DocType).validate_python(fields.get("doc_type"))
+    except ValidationError:
+        raise HTTPException(status_code=422, detail=f"doc_type must be one of {', '.join(DocType.__args__)}")
+
+
+async def cached_extraction(model_service: ModelService, cache: ExtractCache, upload: SpooledUpload, doc_type: DocType) -> tuple[Any, str, str | None]:
+    """
+    Returns the extraction of the upload, how it was obtained (HIT, MISS or SHARED) and the cache tier of a HIT
+    """
+    extracted = {}
+    async for name, value in extraction_events(model_service, cache, upload, doc_type):
+        extracted[name] = value
+    status, tier = extracted.pop("cache")
+    return extracted, status, tier
+
+
+async def extraction_events(model_service: ModelService, cache: ExtractCache, upload: SpooledUpload, doc_type: DocType) -> AsyncIterator[tuple[str, Any]]:
+    """
+    Extracts the upload in stages, yielding each part of the result as soon as it is ready: how it
+    was obtained and the cache tier first, then data and last score_info. The upload is only read
+    before the first part. Identical requests share each stage while it is in progress
+    """
+    key = cache.key(await upload.sha256(), doc_type, extraction_version(doc_type))
+    cached, tier = await cache.get(key)
+    if cached is not None:
+        yield "cache", ("HIT", tier)
+        yield "data", cached["data"]
+        yield "score_info", cached["score_info"]
+        return
+    buffer = await upload.read()
+    data, shared = await extractions.do(f"{key}:data", lambda: extract(model_service, buffer, doc_type))
+    yield "cache", ("SHARED" if shared else "MISS", None)
+    yield "data", data
+    score_info, _ = await extractions.do(f"{key}:audit", lambda: audit(model_service, cache, key, doc_type, data))
+    yield "score_info", score_info
+
+
+async def extract(model_service: ModelService, buffer: bytes, doc_type: DocType):
     part = Part.from_bytes(data=buffer, mime_type="application/pdf")
-    checked_doc_type = await model_service.get_doc_type(part)
-    if checked_doc_type != doc_type:
-        raise HTTPException(status_code=400, detail=f"File was not recognized as a {doc_type} instead it is recognized as {checked_doc_type}")
+    # Shares the gemini quota with the loads being processed
+    async with get_gemini_limit():
+        checked_doc_type = await model_service.get_doc_type(part)
+        if checked_doc_type != doc_type:
+            raise HTTPException(status_code=400, detail=f"File was not recognized as a {doc_type} instead it is recognized as {checked_doc_type}")
 
-    extracted = await model_service.extract_info(part, doc_type)
-    # Publish to rabbit if flag
-    return extracted
+        return await model_service.extract_data(part, doc_type)
+
+
+async def audit(model_service: ModelService, cache: ExtractCache, key: str, doc_type: DocType, data: Any):
+    async with get_gemini_limit():
+        score_info = await model_service.get_score_info(doc_type, data)
+    await cache.set(key, {"data": data, "score_info": score_info})
+    return score_info
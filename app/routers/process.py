@@ -1,12 +1,16 @@
-import asyncio
 import logging
-import threading
+import uuid
 from typing import Annotated
 
-from fastapi import APIRouter, BackgroundTasks
+from fastapi import APIRouter, HTTPException
 from fastapi import Depends
+from app.dto.entity_store import EntityStore
+from app.dto.job import LoadJob
 from app.dto.process import ProcessRequest
+from app.services.job_manager import JobManager, get_job_manager
 from app.services.process_service import ProcessService, get_process_service
+from app.utils.cancellation import CancellationRegistry, get_cancellations
+from app.worker.broker import broadcast_cancel
 
 """
 Update: due to the rabbitmq addition, this endpoint has become not directly accessed by other microservices
@@ -17,32 +21,48 @@ logger = logging.getLogger("uvicorn.error")
 
 process_router = APIRouter()
 
-def run_in_thread(target_function):
-    """Decorator to run a function in a separate thread."""
+@process_router.post("/process", status_code=202)
+async def process(process_service: Annotated[ProcessService, Depends(get_process_service)],
+                  jobs: Annotated[JobManager, Depends(get_job_manager)],
+                  request: ProcessRequest):
+    """
+    Queues the load in the job manager, runs in the app loop sharing the limits with the broker
+    """
+    if jobs.submit(process_service, request) is None:
+        raise HTTPException(status_code=409, detail=f"Load {request.load_id} is already in progress")
+    return {
+        'message': "Queued",
+        'status': f"/process/{request.load_id}"
+    }
+
 
-    def run(*k, **kw):
-        t = threading.Thread(target=target_function, args=k, kwargs=kw)
-        t.start()
-        return t
+@process_router.get("/process/{load_id}", response_model=LoadJob)
+async def status(load_id: uuid.UUID, jobs: Annotated[JobManager, Depends(get_job_manager)]):
+    job = jobs.get(load_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Load {load_id} not found")
+    return job
 
-    return run
 
-@run_in_thread
-def process_files(process_service: ProcessService, request: ProcessRequest):
+@process_router.get("/process/{load_id}/result", response_model=list[EntityStore])
+async def result(load_id: uuid.UUID, jobs: Annotated[JobManager, Depends(get_job_manager)]):
+    results = jobs.results(load_id)
+    if results is None:
+        raise HTTPException(status_code=404, detail=f"Load {load_id} has no results, it is not finished or not found")
+    return results
+
+
+@process_router.post("/process/{load_id}/cancel", status_code=202)
+async def cancel(load_id: uuid.UUID, cancellations: Annotated[CancellationRegistry, Depends(get_cancellations)]):
     """
-    Little wrapper to run the whole process in
+    Cancels the load here and in the other instances, the files of the load still queued are skipped
     """
+    running = cancellations.cancel(load_id)
     try:
-        logger.info("Process received, starting...")
-        asyncio.run(process_service.process_files(request))
+        await broadcast_cancel(load_id)
     except Exception:
-        logger.exception("General error executing process")
-
-@process_router.post("/process", status_code=202)
-async def process(background_tasks: BackgroundTasks,
-                  process_service: Annotated[ProcessService, Depends(get_process_service)],
-                  request: ProcessRequest):
-    background_tasks.add_task(process_files,process_service, request)
+        logger.exception(f"Error publishing the cancellation of {load_id}, only cancelled in this instance")
     return {
-        'message':"Queued"
-    }
\ No newline at end of file
+        'message': "Cancelling",
+        'running_here': running
+    }
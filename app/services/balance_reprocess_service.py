@@ -14,7 +14,7 @@ class BalanceReprocessService:
         if last_order:
             # Read the fiduciary balance prompt and insert the last_order parameter
             prompt_with_order = self.read_prompt_with_last_order(last_order)
-            mres = await self.model_service.make_prompt_with_file(prompt_with_order, self.file.part)
+            mres = await self.model_service.make_prompt_with_file(prompt_with_order, self.file.part, 'reprocess', 'Saldo_Fiduciario')
             res = mres.text.strip()
             
             # Remove markdown code block formatting if present
@@ -1,18 +1,30 @@
+import asyncio
 import io
 import logging
+import tempfile
 import zipfile
+from concurrent.futures import Executor
+from mimetypes import guess_type
 from pathlib import PurePosixPath
+from typing import Annotated, AsyncIterator, Iterator
+
+from fastapi import Depends
 from google.cloud import storage
 from google.api_core.exceptions import NotFound, Forbidden
-from google.cloud.storage import Blob
+from google.cloud.storage import Blob, Bucket
+from google.genai.types import Part
+
+from app.dependencies import Settings, get_settings, get_transfer_executor, get_storage_client
+from app.utils.blob_cache import BlobCache, get_blob_cache
+from app.utils.file import PartFile, FileInspection
+from app.utils.get_blob_file import get_file_from_storage
+from app.utils.preflight import inspect_blob
 
 logger = logging.getLogger("uvicorn.error")
-# WARNING: THIS IS JUST A FAILSAFE TO AVOID DOING MUCH WORK PER SIMPLE REQUEST OR BATCH
-# THE ARCHITECTURE RIGHT NOW IS NOT ROBUST ENOUGH TO SUPPORT A FAILOVER OR A SERVICE FAIL
-# THE IDEA IS TO IMPLEMENT A BROKER WITH AN EVENT ORIENTED ARCHITECTURE, THIS WILL ALLOW US
-# TO HANDLE RETRIES, BETTER ERROR HANDLING AND THE MOST IMPORTANT THING THAT IS RESUME A PROCESS
-# IF IT IS NOT ENDED
-MAX_FILE_PROCESSING = 300
+# Bucket handles are lazy, they are validated once per process and reused by every message
+_buckets: dict[str, Bucket] = {}
+# Only the fields used by the pipeline are requested when listing, the rest of the blob metadata is not needed
+LIST_FIELDS = "items(name,size,md5Hash,crc32c,contentType,generation),nextPageToken"
 
 ALLOWED_EXTENSIONS = {".pdf", ".png", ".jpg", ".jpeg"}
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
@@ -20,8 +32,16 @@ MAX_TOTAL_UNCOMPRESSED = 500 * 1024 * 1024  # 500 MB
 MAX_FILES = 200  # MAX ZIP FILES
 
 
-def get_bucket_service():
-    return BucketService()
+def get_bucket_service(config: Annotated[Settings, Depends(get_settings)],
+                       executor: Annotated[Executor, Depends(get_transfer_executor)],
+                       client: Annotated[storage.Client, Depends(get_storage_client)],
+                       cache: Annotated[BlobCache | None, Depends(get_blob_cache)]):
+    return BucketService(
+        config=config,
+        executor=executor,
+        client=client,
+        cache=cache
+    )
 
 
 def _infer_bucket_name(gs_path: str):
@@ -31,64 +51,176 @@ def _infer_bucket_name(gs_path: str):
     return bucket_name, prefix
 
 
+def zip_base_path(zip_name: str):
+    """
+    Folder where the members of a zip are placed, eg: docs/archive.zip => docs/archive
+    """
+    zip_path = PurePosixPath(zip_name)
+    return f"{zip_path.parent}/{zip_path.stem}"
+
+
+def is_processable(blob_name: str, prefix: str):
+    """
+    Check if a blob under the prefix of a load has to be processed, it is a zip or a valid file, this is:
+    - Is not a folder
+    - is not too nested
+    - has the right extension
+    """
+    if blob_name.endswith(".zip"):
+        return True
+    # Strip the prefix, e.g. "docs/" from "docs/file1.pdf" => "file1.pdf"
+    relative = blob_name[len(prefix):]
+
+    if relative.endswith('/'):
+        return False
+
+    depth = relative.count('/')
+    if depth > 2:
+        return False
+
+    ext = PurePosixPath(blob_name).suffix.lower()
+    return ext in ALLOWED_EXTENSIONS
+
+
+def _is_safe_zip(archive: zipfile.ZipFile, zip_name: str) -> bool:
+    file_list = archive.infolist()
+    if len(file_list) > MAX_FILES:
+        logger.warning(f"Skipping {zip_name}: too many files ({len(file_list)} > {MAX_FILES})")
+        return False
+    total_uncompressed = sum(f.file_size for f in file_list)
+    if total_uncompressed > MAX_TOTAL_UNCOMPRESSED:
+        logger.warning(
+            f"Skipping {zip_name}: uncompressed size too big ({total_uncompressed} > {MAX_TOTAL_UNCOMPRESSED})")
+        return False
+    return True
+
+
+def _iter_zip_members(archive: zipfile.ZipFile) -> Iterator[tuple[zipfile.ZipInfo, str]]:
+    """
+    Yields the members of the zip that can be processed along with their filename
+    """
+    for file_info in archive.infolist():
+        if file_info.is_dir():
+            # Ignore subdirs: NOT SUPPORTED
+            logger.warning("Detecting folders in the zip, THIS IS NOT SUPPORTED !! Ignoring...")
+            continue
+
+        original_filename = PurePosixPath(file_info.filename).name
+        ext = PurePosixPath(original_filename).suffix.lower()
+        if ext not in ALLOWED_EXTENSIONS:
+            logger.warning(f"Unsupported file: {original_filename}, skipping")
+            continue
+        yield file_info, original_filename
+
+
 class BucketService:
 
-    async def flatten_bucket(self, gs_path: str):
+    def __init__(self, config: Settings, executor: Executor, client: storage.Client, cache: BlobCache | None = None):
+        self.config = config
+        # every blocking call to gcs goes through this executor
+        self.executor = executor
+        self.client = client
+        # downloaded files kept on disk, see get_blob_cache
+        self.cache = cache
+
+    async def download(self, blob: Blob, data: bytes | None = None) -> PartFile:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, get_file_from_storage, blob, self.cache, data)
+
+    async def inspect(self, blob: Blob) -> tuple[FileInspection, bytes | None]:
         """
-        This method will flatten all zips in the specified gcp bucket,
-        this is: extract them in subfolder to keep them organized and adding them metadata.
-        Due to time constraints this is the best solution i have come so far, single threaded,
-        could be optimized maybe somehow with multithreading speeding the flatten of zips
-        that is a TODO
+        Pre-flight inspection of a blob from its header and trailer, without downloading it.
+        The content comes with it when it was read whole, to be passed to download
         """
-        bucket_name, prefix = _infer_bucket_name(gs_path)
-        bucket = self.__get_bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=prefix, max_results=MAX_FILE_PROCESSING)
-        for blob in blobs:
-            # if not a zip ignore them
-            if not blob.name.endswith(".zip"):
-                continue
-            logger.info(f"Detecting zip: {blob.name}")
-            zip_data = blob.download_as_bytes()
-            zip_base = PurePosixPath(blob.name).stem  # removes .zip
-            base_path = f"{PurePosixPath(blob.name).parent}/{zip_base}"
-            with zipfile.ZipFile(io.BytesIO(zip_data)) as archive:
-
-                # Safety checks
-                file_list = archive.infolist()
-                if len(file_list) > MAX_FILES:
-                    logger.warning(f"Skipping {blob.name}: too many files ({len(file_list)} > {MAX_FILES})")
-                    continue
-                total_uncompressed = sum(f.file_size for f in file_list)
-                if total_uncompressed > MAX_TOTAL_UNCOMPRESSED:
-                    logger.warning(
-                        f"Skipping {blob.name}: uncompressed size too big ({total_uncompressed} > {MAX_TOTAL_UNCOMPRESSED})")
-                    continue
-
-                for file_info in archive.infolist():
-                    if file_info.is_dir():
-                        # Ignore subdirs: NOT SUPPORTED
-                        logger.warning("Detecting folders in the zip, THIS IS NOT SUPPORTED !! Ignoring...")
-                        continue
-
-                    original_filename = PurePosixPath(file_info.filename).name
-                    ext = PurePosixPath(original_filename).suffix.lower()
-                    if ext not in ALLOWED_EXTENSIONS:
-                        logger.warning(f"Unsupported file: {original_filename}, skipping")
-                        continue
+        return await asyncio.get_running_loop().run_in_executor(self.executor, inspect_blob, blob, self.cache)
 
+    async def flatten_zip(self, blob: Blob) -> list[Blob]:
+        """
+        This method will flatten a zip in the gcp bucket,
+        this is: extract it in a subfolder to keep them organized and adding them metadata.
+        Returns the extracted blobs so they can be processed without listing the bucket again
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.__flatten_zip, blob)
+
+    def __flatten_zip(self, blob: Blob) -> list[Blob]:
+        logger.info(f"Detecting zip: {blob.name}")
+        zip_data = blob.download_as_bytes()
+        base_path = zip_base_path(blob.name)
+        extracted = []
+        with zipfile.ZipFile(io.BytesIO(zip_data)) as archive:
+
+            # Safety checks
+            if not _is_safe_zip(archive, blob.name):
+                return extracted
+
+            for file_info, original_filename in _iter_zip_members(archive):
+                extract_path = f"{base_path}/{original_filename}"
+
+                with archive.open(file_info) as extracted_file:
+                    target_blob = blob.bucket.blob(extract_path)
+                    target_blob.upload_from_file(extracted_file)
+                    extracted.append(target_blob)
+        logger.info(f"Extracted zip {blob.name}, deleting...")
+        blob.delete()
+        return extracted
+
+    async def expand_zip(self, blob: Blob) -> AsyncIterator[PartFile]:
+        """
+        In memory alternative to flatten_zip, instead of uploading the members of the zip
+        and listing them again later they are yielded as PartFiles ready to be sent to gemini.
+        The zip is spooled (in memory up to zip_spool_max_size, then on disk) and each member is
+        decompressed off the event loop when requested, so the first member can be processed
+        while the rest are still waiting in the archive.
+        Persisting the members in the bucket is an optional side effect done in background,
+        only when every member was uploaded the original zip is deleted
+        """
+        loop = asyncio.get_running_loop()
+        base_path = zip_base_path(blob.name)
+        uploads = []
+        logger.info(f"Expanding zip in memory: {blob.name}")
+        with tempfile.SpooledTemporaryFile(max_size=self.config.zip_spool_max_size) as spool:
+            await loop.run_in_executor(self.executor, blob.download_to_file, spool)
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as archive:
+                if not _is_safe_zip(archive, blob.name):
+                    return
+
+                for file_info, original_filename in _iter_zip_members(archive):
+                    # decompressing is not a transfer, it does not take a transfer thread
+                    data = await loop.run_in_executor(None, archive.read, file_info)
                     extract_path = f"{base_path}/{original_filename}"
+                    if self.config.zip_persist_members:
+                        uploads.append(
+                            loop.run_in_executor(self.executor, self.__upload_bytes, blob.bucket, extract_path, data))
+                    yield PartFile(
+                        # Same mimetype handling as get_file_from_storage
+                        part=Part.from_bytes(data=data, mime_type=guess_type(original_filename)[0]),
+                        path=f"gs://{blob.bucket.name}/{extract_path}",
+                        original_filename=original_filename,
+                        parent_file=PurePosixPath(blob.name).name
+                    )
+
+        if not uploads:
+            return
+        results = await asyncio.gather(*uploads, return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logger.error(f"{len(failed)} members of {blob.name} could not be persisted, keeping the zip: {failed[0]}")
+            return
+        logger.info(f"Persisted zip members of {blob.name}, deleting...")
+        await loop.run_in_executor(self.executor, blob.delete)
 
-                    with archive.open(file_info) as extracted_file:
-                        target_blob = bucket.blob(extract_path)
-                        target_blob.upload_from_file(extracted_file)
-            logger.info(f"Extracted zip {blob.name}, deleting...")
-            blob.delete()
+    @staticmethod
+    def __upload_bytes(bucket: Bucket, name: str, data: bytes):
+        bucket.blob(name).upload_from_string(data)
 
-    def __get_bucket(self, bucket_name: str):
-        client = storage.Client()
+    async def __get_bucket(self, bucket_name: str):
+        if bucket_name in _buckets:
+            return _buckets[bucket_name]
+        bucket = self.client.bucket(bucket_name)
         try:
-            bucket = client.get_bucket(bucket_name)
+            # Only validated the first time, afterwards the handle is used without the metadata request
+            await asyncio.get_running_loop().run_in_executor(self.executor, bucket.reload)
+            _buckets[bucket_name] = bucket
             return bucket
         except NotFound:
             logger.error(f"Bucket {bucket_name} not found aborting...")
@@ -100,38 +232,30 @@ class BucketService:
             logger.exception("Unknown error getting bucket")
             raise e
 
-    def list_files(self, gs_path) -> list[Blob]:
+    async def iter_blob_pages(self, gs_path: str) -> AsyncIterator[list[Blob]]:
+        """
+        Lists the gs path page by page, yielding the zips and the files that can be processed
+        as soon as each page arrives. Each page is fetched off the event loop and only when the
+        previous one was consumed, so the caller controls how much of the listing is held in memory
+        """
         bucket_name, prefix = _infer_bucket_name(gs_path)
-        bucket = self.__get_bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=prefix, max_results=MAX_FILE_PROCESSING)
-        files = []
-        for blob in blobs:
-            if self.__is_valid_file(blob.name, prefix):
-                files.append(blob)
-                if len(files) >= MAX_FILE_PROCESSING:
-                    break
-        return files
-
-    def move_file(self):
-        ...
+        bucket = await self.__get_bucket(bucket_name)
+        pages = bucket.list_blobs(prefix=prefix, page_size=self.config.list_page_size, fields=LIST_FIELDS).pages
+        loop = asyncio.get_running_loop()
+        while True:
+            page = await loop.run_in_executor(self.executor, next, pages, None)
+            if page is None:
+                return
+            yield [blob for blob in page if is_processable(blob.name, prefix)]
 
-    def __is_valid_file(self, blob_name: str, prefix: str):
+    async def get_blob(self, gs_path: str) -> Blob | None:
         """
-        Check if a file in the bucket is valid, this is:
-        - Is not a folder
-        - is not too nested
-        - has the right extension
+        Gets a single blob with its metadata, None if it doesn't exist
         """
-        # Strip the prefix, e.g. "docs/" from "docs/file1.pdf" => "file1.pdf"
-        relative = blob_name[len(prefix):]
+        bucket_name, name = _infer_bucket_name(gs_path)
+        bucket = await self.__get_bucket(bucket_name)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, bucket.get_blob, name)
 
-        if relative.endswith('/'):
-            return False
-
-        depth = relative.count('/')
-        if depth > 2:
-            return False
-
-        ext = PurePosixPath(blob_name).suffix.lower()
-        return ext in ALLOWED_EXTENSIONS
+    def move_file(self):
+        ...
 
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+from app.dependencies import get_settings, Settings
+
+logger = logging.getLogger("uvicorn.error")
+
+
+@lru_cache()
+def get_extract_cache():
+    return ExtractCache(get_settings())
+
+
+class ExtractCache:
+    """
+    Results of /extract by document, the key is the hash of the file, the doc type and the version of
+    the prompts and model, so changing a prompt doesn't return stale extractions.
+    Entries live extract_cache_ttl seconds in an LRU of extract_cache_size entries, with
+    extract_cache_dir they are also written to disk so they survive restarts and the LRU evictions,
+    the disk keeps the newest files up to extract_cache_disk_max_bytes
+    """
+
+    def __init__(self, config: Settings):
+        self.__config = config
+        self.__entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.__dir = Path(config.extract_cache_dir) if config.extract_cache_dir else None
+        if self.__dir is not None:
+            self.__dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(sha256: str, doc_type: str, version: str) -> str:
+        return f"{sha256}-{doc_type}-{version}"
+
+    async def get(self, key: str) -> tuple[Any, str | None]:
+        """
+        Returns the cached result and the tier it was found in (memory or disk), None if not cached
+        """
+        entry = self.__entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self.__entries.move_to_end(key)
+                return value, "memory"
+            del self.__entries[key]
+        if self.__dir is None:
+            return None, None
+        value = await asyncio.to_thread(self.__read, key)
+        if value is None:
+            return None, None
+        self.__remember(key, value)
+        return value, "disk"
+
+    async def set(self, key: str, value: Any):
+        self.__remember(key, value)
+        if self.__dir is not None:
+            await asyncio.to_thread(self.__write, key, value)
+
+    def __remember(self, key: str, value: Any):
+        self.__entries[key] = (time.monotonic() + self.__config.extract_cache_ttl, value)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__config.extract_cache_size:
+            self.__entries.popitem(last=False)
+
+    def __read(self, key: str) -> Any:
+        path = self.__dir / f"{key}.json"
+        try:
+            if time.time() - path.stat().st_mtime > self.__config.extract_cache_ttl:
+                path.unlink(missing_ok=True)
+                return None
+            # Read hits count as uses so the eviction keeps them
+            os.utime(path)
+            return json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.warning(f"Unreadable extract cache entry {path}, ignoring", exc_info=True)
+            return None
+
+    def __write(self, key: str, value: Any):
+        path = self.__dir / f"{key}.json"
+        temp = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            temp.write_text(json.dumps(value, ensure_ascii=False, default=str), encoding="utf-8")
+            # Readers see the old entry or the new one, never half a file
+            os.replace(temp, path)
+        except OSError:
+            logger.warning(f"Error writing extract cache entry {path}", exc_info=True)
+            temp.unlink(missing_ok=True)
+            return
+        self.__evict()
+
+    def __evict(self):
+        files = []
+        for path in self.__dir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.__config.extract_cache_disk_max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
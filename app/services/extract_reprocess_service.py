@@ -49,7 +49,7 @@ class ExtractReprocessService:
                     logger.info(f"Reprocessing movimientos from: value{value}, subsequentBalance{subsequentBalance}")
                     prompt_with_context = self.read_movimientos_prompt_with_context(value, subsequentBalance)
                 
-                mres = await self.model_service.make_prompt_with_file(prompt_with_context, self.file.part)
+                mres = await self.model_service.make_prompt_with_file(prompt_with_context, self.file.part, 'reprocess', 'Extracto')
                 res = mres.text.strip()
                 
                 # Remove markdown code block formatting if present
@@ -119,7 +119,7 @@ class ExtractReprocessService:
                     logger.info(f"Reprocessing encargos from: trustName{trustName}, trustDate{trustDate}")
                     prompt_with_context = self.read_encargos_prompt_with_context(trustName, trustDate)
 
-                mres = await self.model_service.make_prompt_with_file(prompt_with_context, self.file.part)
+                mres = await self.model_service.make_prompt_with_file(prompt_with_context, self.file.part, 'reprocess', 'Extracto')
                 res = mres.text.strip()
                 
                 # Remove markdown code block formatting if present
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from app.dependencies import get_settings
+from app.dto.entity_store import EntityStore
+from app.dto.job import LoadJob, FileProgress
+from app.dto.process import ProcessRequest
+from app.services.process_service import ProcessService
+from app.utils.cancellation import get_cancellations
+
+logger = logging.getLogger("uvicorn.error")
+MAX_FINISHED_JOBS = 200 # finished loads kept with their results for the status api
+ENDED_STATUSES = {'DONE', 'FAILED', 'CANCELLED'}
+
+
+@lru_cache()
+def get_job_manager():
+    return JobManager(get_settings().max_concurrent_loads)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class JobManager:
+    """
+    Runs the loads of the /process endpoint as tasks of the app loop, so they share the clients and
+    the process wide limits with the broker. At most max_concurrent_loads run at the same time, the
+    rest wait queued. The state of every load and its files is kept to be polled, the finished ones
+    are forgotten after MAX_FINISHED_JOBS
+    """
+
+    def __init__(self, max_concurrent_loads: int):
+        self.__slots = asyncio.Semaphore(max_concurrent_loads)
+        self.__jobs: OrderedDict[uuid.UUID, LoadJob] = OrderedDict()
+        self.__results: dict[uuid.UUID, list[EntityStore]] = {}
+        self.__tasks: dict[uuid.UUID, asyncio.Task] = {}
+
+    def submit(self, process_service: ProcessService, request: ProcessRequest) -> LoadJob | None:
+        """
+        Queues the load, None if the same load is already queued or running
+        """
+        job = self.__jobs.get(request.load_id)
+        if job is not None and job.status not in ENDED_STATUSES:
+            return None
+        get_cancellations().forget(request.load_id)
+        job = LoadJob(load_id=request.load_id, queued_at=_now())
+        self.__jobs[request.load_id] = job
+        self.__jobs.move_to_end(request.load_id)
+        self.__results.pop(request.load_id, None)
+        self.__tasks[request.load_id] = asyncio.create_task(self.__run(process_service, request, job))
+        return job
+
+    def get(self, load_id: uuid.UUID) -> LoadJob | None:
+        return self.__jobs.get(load_id)
+
+    def results(self, load_id: uuid.UUID) -> list[EntityStore] | None:
+        return self.__results.get(load_id)
+
+    async def shutdown(self):
+        """
+        Cancels the loads still running, called when the app stops
+        """
+        tasks = list(self.__tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __run(self, process_service: ProcessService, request: ProcessRequest, job: LoadJob):
+        try:
+            with get_cancellations().watch(request.load_id) as cancel:
+                async with self.__slots:
+                    if cancel.is_set():
+                        job.status = 'CANCELLED'
+                        return
+                    job.status = 'RUNNING'
+                    job.started_at = _now()
+                    logger.info(f"Load {request.load_id} started")
+                    results = await process_service.process_files(
+                        request, cancel=cancel, on_progress=lambda name, state: self.__progress(job, name, state))
+                    self.__results[request.load_id] = results or []
+                    job.result = f"/process/{request.load_id}/result"
+                    job.status = 'CANCELLED' if cancel.is_set() else 'DONE'
+        except asyncio.CancelledError:
+            job.status = 'CANCELLED'
+            raise
+        except Exception:
+            logger.exception(f"General error executing load {request.load_id}")
+            job.status = 'FAILED'
+        finally:
+            job.ended_at = _now()
+            del self.__tasks[request.load_id]
+            self.__forget_finished()
+
+    @staticmethod
+    def __progress(job: LoadJob, name: str, state: str):
+        file = job.files.get(name)
+        if file is None:
+            job.files[name] = FileProgress(status=state, queued_at=_now())
+            return
+        file.status = state
+        if state in ('DOWNLOADING', 'PROCESSING'):
+            file.started_at = file.started_at or _now()
+        elif state != 'QUEUED':
+            file.ended_at = _now()
+
+    def __forget_finished(self):
+        finished = [load_id for load_id, job in self.__jobs.items() if job.status in ENDED_STATUSES]
+        for load_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.__jobs[load_id]
+            self.__results.pop(load_id, None)
@@ -1,23 +1,47 @@
+import hashlib
 import logging
 import uuid
+from functools import lru_cache
 from typing import Annotated, Dict, Any, Optional, Callable
 from fastapi import Depends
 from google import genai
-from google.genai.types import Part
+from google.genai.errors import ClientError
+from google.genai.types import Part, GenerateContentConfig
 import re
 
-from analyzers.analyzer import DOCUMENT_CONFIG, CATEGORY_PROMPT_PATH
-from app.dependencies import Settings, get_settings
+from analyzers.document_config import DOCUMENT_CONFIG, CATEGORY_PROMPT_PATH, DEFAULT_MODEL, MODEL_FALLBACKS, \
+    MODEL_MAX_OUTPUT_TOKENS, model_profile
+from app.dependencies import get_genai_client
 from app.dto.process import DocType
 from app.utils.json_parse import gemini_json_parse
+from app.utils.prompt import load_prompt
 
 logger = logging.getLogger("uvicorn.error")
-GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_MODEL = DEFAULT_MODEL # each stage uses the model of its profile, see MODEL_PROFILES
+QUOTA_EXHAUSTED = 429
 
 
-def get_model_service(config: Annotated[Settings, Depends(get_settings)]):
+@lru_cache()
+def extraction_version(doc_type: DocType) -> str:
+    """
+    Version of the extraction of a doc type: the model profiles, the category descriptions and the
+    prompts used, a change in any of them gives another version
+    """
+    config: Dict[str, Any] = DOCUMENT_CONFIG.get(doc_type, {})
+    digest = hashlib.sha256()
+    for stage in ('classify', 'extract', 'audit'):
+        digest.update(repr(sorted(model_profile(stage, doc_type).items())).encode())
+    for category in DOCUMENT_CONFIG.values():
+        digest.update(category.get('description', '').encode())
+    for path in (CATEGORY_PROMPT_PATH, config.get('prompt_path'), config.get('audit_path')):
+        if path:
+            digest.update(load_prompt(path).encode())
+    return digest.hexdigest()[:16]
+
+
+def get_model_service(genai_client: Annotated[genai.Client, Depends(get_genai_client)]):
     return ModelService(
-        config=config
+        genai_client=genai_client
     )
 
 
@@ -25,17 +49,29 @@ class ModelService:
     """
     This service unifies the genai calls across the internal processing,
     and the API sync request, some more generic methods, like direct prompting
-    and some specific like infer doctype
+    and some specific like infer doctype.
+    Every call belongs to a stage (classify, extract, audit, reprocess) and is made with the model
+    profile of the stage and doc type declared in the document config
     """
 
-    def __init__(self, config: Settings):
-        self.__genai_client = genai.Client(vertexai=True, project=config.project_id, location=config.region)
+    def __init__(self, genai_client: genai.Client):
+        # shared by the whole process, see get_genai_client
+        self.__genai_client = genai_client
 
     async def extract_info(self, file: Part, doc_type: DocType):
+        data = await self.extract_data(file, doc_type)
+        return {"data": data,
+                "score_info": await self.get_score_info(doc_type, data)
+                }
+
+    async def extract_data(self, file: Part, doc_type: DocType):
+        """
+        Only the extraction of extract_info, without the audit, for the callers that can use the data
+        before it is scored
+        """
         config: Dict[str, Any] = DOCUMENT_CONFIG[doc_type]
         try:
-            with open(config['prompt_path'], "r", encoding='utf-8') as f:
-                extraction_prompt: str = f.read()
+            extraction_prompt: str = load_prompt(config['prompt_path'])
 
         except FileNotFoundError as e:
             logger.error(f"No se encontró el archivo de prompt: {e}", exc_info=True)
@@ -44,13 +80,8 @@ class ModelService:
             logger.error(f"Error leyendo archivos de prompt: {e}", exc_info=True)
             raise RuntimeError
 
-        mres = await self.__genai_client.aio.models.generate_content(model=GEMINI_MODEL,
-                                                                     contents=[file, extraction_prompt])
-        score_info = await self.get_score_info(doc_type, gemini_json_parse(mres.text))
-        
-        return { "data" : gemini_json_parse(mres.text),
-                 "score_info": score_info 
-                }
+        mres = await self.generate('extract', [file, extraction_prompt], doc_type)
+        return gemini_json_parse(mres.text)
 
     async def get_doc_type(self, file: Part):
         """
@@ -58,8 +89,7 @@ class ModelService:
         """
         known_categories = DOCUMENT_CONFIG.keys()
         try:
-            with open(CATEGORY_PROMPT_PATH, "r", encoding="utf-8") as f:
-                prompt_template = f.read()
+            prompt_template = load_prompt(CATEGORY_PROMPT_PATH)
         except FileNotFoundError:
             logger.exception(f"No se encontró el archivo de prompt de categorías en {CATEGORY_PROMPT_PATH}")
 
@@ -68,7 +98,7 @@ class ModelService:
             for cat, conf in DOCUMENT_CONFIG.items()
         )
         prompt = prompt_template.format(category_descriptions=category_descriptions)
-        response = await self.__genai_client.aio.models.generate_content(model=GEMINI_MODEL, contents=[file, prompt])
+        response = await self.generate('classify', [file, prompt])
         determined_category = response.text.strip()
         for valid_cat in known_categories:
             if determined_category.upper() == valid_cat.upper():
@@ -76,19 +106,48 @@ class ModelService:
 
         return "uncategorized"
 
-    async def make_prompt(self, prompt: str):
-        return await self.__genai_client.aio.models.generate_content(model=GEMINI_MODEL, contents=[prompt])
+    async def make_prompt(self, prompt: str, stage: str, doc_type: Optional[str] = None):
+        return await self.generate(stage, [prompt], doc_type)
+
 
+    async def make_prompt_with_file(self, prompt: str, file: Part, stage: str, doc_type: Optional[str] = None):
+        return await self.generate(stage, [file, prompt], doc_type)
 
-    async def make_prompt_with_file(self, prompt: str, file: Part):
-        return await self.__genai_client.aio.models.generate_content(model=GEMINI_MODEL, contents=[file, prompt])
+    async def generate(self, stage: str, contents: list, doc_type: Optional[str] = None):
+        """
+        Makes the call with the model profile of the stage for the doc type, if the quota of the model
+        is exhausted it is made again with its fallback model
+        """
+        profile = model_profile(stage, doc_type)
+        model = profile['model']
+        try:
+            return await self.__genai_client.aio.models.generate_content(
+                model=model, contents=contents, config=self.__generation_config(profile, model))
+        except ClientError as e:
+            fallback = MODEL_FALLBACKS.get(model)
+            if e.code != QUOTA_EXHAUSTED or not fallback:
+                raise
+            logger.warning(f"Quota of {model} exhausted, {stage} of {doc_type or 'a document'} falls back to {fallback}")
+            return await self.__genai_client.aio.models.generate_content(
+                model=fallback, contents=contents, config=self.__generation_config(profile, fallback))
+
+    @staticmethod
+    def __generation_config(profile: Dict[str, Any], model: str):
+        max_output_tokens = profile.get('max_output_tokens')
+        if max_output_tokens and model in MODEL_MAX_OUTPUT_TOKENS:
+            # The profile can be of a model with a bigger output than the fallback
+            max_output_tokens = min(max_output_tokens, MODEL_MAX_OUTPUT_TOKENS[model])
+        return GenerateContentConfig(
+            max_output_tokens=max_output_tokens,
+            temperature=profile.get('temperature'),
+            response_mime_type=profile.get('response_mime_type'),
+        )
 
     async def get_score_info(self,doc_type: DocType, df_json_text ):
 
         config: Dict[str, Any] = DOCUMENT_CONFIG[doc_type]
         try:
-            with open(config['audit_path'], "r", encoding='utf-8') as f:
-                audit_prompt_template: str = f.read()
+            audit_prompt_template: str = load_prompt(config['audit_path'])
         except FileNotFoundError as e:
             logger.error(f"No se encontró el archivo de prompt: {e}", exc_info=True)
             raise RuntimeError
@@ -97,7 +156,7 @@ class ModelService:
             raise RuntimeError
         
         full_audit_prompt: str = audit_prompt_template.format(df_data=df_json_text)
-        audit_response_text: str = (await self.__genai_client.aio.models.generate_content(model=GEMINI_MODEL, contents=[full_audit_prompt])).text
+        audit_response_text: str = (await self.generate('audit', [full_audit_prompt], doc_type)).text
         audit_result: Dict[str, Any] = gemini_json_parse(audit_response_text)
         validation_data = {}
         scores = audit_result.get("scores", {})
@@ -1,15 +1,17 @@
 import asyncio
+import hashlib
 import logging
 import re
-from typing import Annotated, Dict, Any, Callable, Optional
+from typing import Annotated, Dict, Any, Awaitable, Callable, Optional, AsyncIterator, TYPE_CHECKING
 from datetime import datetime, date
 
-import pandas as pd
 from fastapi import Depends
 from google.cloud.storage import Blob
 from google.genai.errors import ClientError
+from google.genai.types import Part
+from pydantic import BaseModel
 
-from analyzers.analyzer import DOCUMENT_CONFIG, CATEGORY_PROMPT_PATH
+from analyzers.document_config import DOCUMENT_CONFIG, CATEGORY_PROMPT_PATH, normalized_score
 from app.dto.entity.bill import Bill
 from app.dto.entity.buy_order import BuyOrder
 from app.dto.entity.cc import CC
@@ -20,136 +22,480 @@ from app.dto.entity.extract import Extract
 from app.dto.entity.pay import Payment
 from app.dto.entity.rub import RUB
 from app.dto.entity.rut import RUT
+from app.dependencies import Settings, get_settings, get_download_limit, get_gemini_limit, get_optimize_executor
 from app.dto.entity_store import EntityStore
 from app.dto.entity.balance import Balance
 from app.dto.log import Log, ValidationError
-from app.dto.process import ProcessRequest
+from app.dto.process import ProcessRequest, ProcessFileRequest
 from app.services.balance_reprocess_service import BalanceReprocessService
 from app.services.extract_reprocess_service import ExtractReprocessService
 from app.services.bucket_service import BucketService, get_bucket_service
 from app.services.model_service import get_model_service, ModelService
-from app.utils.file import PartFile
-from app.utils.get_blob_file import get_file_from_storage
+from app.utils.drain import Drain
+from app.utils.file import PartFile, FileInspection
 from app.utils.json_parse import gemini_json_parse
+from app.utils.optimize import OptimizedPayload, PayloadSavings, optimize_payload, available as optimization_available
 from app.services.analytical_helper_service import AnalyticalHelperService
+from app.utils.preflight import inspect_content, truncated_image, HEAD_SIZE, TAIL_SIZE
+from app.utils.prompt import load_prompt
+from app.utils.single_flight import SingleFlight
+from app.utils.transient import is_transient
 import json
 
+if TYPE_CHECKING:
+    # pandas is imported when the first document is extracted, not at startup
+    import pandas as pd
+
 logger = logging.getLogger("uvicorn.error")
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MBs
+# The same document in several zips of a load, or in loads running at the same time, is classified
+# and analyzed once while it is in progress, keyed by the stage and the hash of its content
+documents = SingleFlight()
 
 
 def get_process_service(bucket_service: Annotated[BucketService, Depends(get_bucket_service)],
-                        model_service: Annotated[ModelService, Depends(get_model_service)]):
+                        model_service: Annotated[ModelService, Depends(get_model_service)],
+                        config: Annotated[Settings, Depends(get_settings)]):
     return ProcessService(
         bucket_service=bucket_service,
-        model_service=model_service
+        model_service=model_service,
+        config=config
     )
 
+class CascadeStats(BaseModel):
+    files: int = 0
+    escalated: int = 0 # extracted again with the stronger model
+
+
 class ProcessService:
 
-    def __init__(self, bucket_service: BucketService, model_service: ModelService):
+    def __init__(self, bucket_service: BucketService, model_service: ModelService, config: Settings):
         self.bucket_service = bucket_service
         self.model_service = model_service
+        self.config = config
+        self.on_result = None
+        self.on_progress = None
+        # Files that ended in ERROR for a transient failure, they could work if processed again later
+        self.transient_failures: set[str] = set()
+        self.interrupted = False
+        self.finished_files: list[str] = []
+        # What the payload optimization saved, by doc type
+        self.payload_savings: dict[str, PayloadSavings] = {}
+        # Files extracted in cascade mode and how many of them were escalated, by doc type, a file
+        # that shared the analysis of an identical one counts with its outcome
+        self.cascade_stats: dict[str, CascadeStats] = {}
     
-    async def process_files(self, request: ProcessRequest):
+    async def process_files(self, request: ProcessRequest, on_result: Optional[Callable[[str, EntityStore], None]] = None,
+                            drain: Optional[Drain] = None, cancel: Optional[asyncio.Event] = None,
+                            on_progress: Optional[Callable[[str, str], None]] = None):
+        """
+        Processes every file of the load, on_result is called with the blob name and the result of each
+        file as soon as it ends and on_progress with the blob name and its state (QUEUED, DOWNLOADING, PROCESSING, then its log status).
+        If the drain starts no more files are admitted and the ones in progress have until its deadline,
+        then the load is left interrupted with the files finished in finished_files.
+        If the load is cancelled the listing and the files in progress stop right away, the files
+        admitted and not finished are returned as CANCELLED
+        """
         logger.info(f"Starting batch processing with id: {request.load_id}")
-        await self._preprocess(request.gs_path)
-        logger.info("Preprocessing ended, starting batch processing")
-        blobs = self.bucket_service.list_files(request.gs_path)
-        if len(blobs) == 0:
+        self.__init_limits()
+        self.on_result = on_result
+        self.on_progress = on_progress
+
+        tasks: dict[str, asyncio.Task] = {} # by blob name
+        watchers = []
+        try:
+            async with asyncio.TaskGroup() as tg:
+                listing = tg.create_task(self.__admit_files(tg, request, tasks))
+                if drain is not None:
+                    watchers.append(asyncio.create_task(self.__stop_on_drain(drain, listing, tasks)))
+                if cancel is not None:
+                    watchers.append(asyncio.create_task(self.__stop_on_cancel(cancel, listing, tasks)))
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+        self.__report_savings(request)
+        self.__report_cascade(request)
+
+        finished = {name: task for name, task in tasks.items() if not task.cancelled()}
+        self.finished_files = list(finished)
+        if cancel is not None and cancel.is_set():
+            logger.warning(f"Load {request.load_id} cancelled, {len(finished)} of {len(tasks)} admitted files finished")
+            cancelled = [self.__emit(name, self.__error_store(request, name, None, status="CANCELLED"))
+                         for name in tasks if name not in finished]
+            return [t.result() for t in finished.values()] + cancelled
+        self.interrupted = listing.cancelled() or len(finished) < len(tasks)
+        if self.interrupted:
+            logger.warning(f"Load {request.load_id} interrupted by the drain, {len(finished)} of {len(tasks)} admitted files finished")
+        elif len(tasks) == 0:
             logger.warning("WARNING, the bucket is empty or no compatible files were found")
             return
+        else:
+            logger.info(f"Processing files ended")
 
-        # INIT SEMAPHORES HERE: asyncio semaphores are not thread safe and the fastapi thread should not create them
-        self.download_semaphore = asyncio.Semaphore(50)
-        self.processing_semaphore = asyncio.Semaphore(50)
+        return [t.result() for t in finished.values()]
 
-        tasks = []
-        async with asyncio.TaskGroup() as tg:
-            tasks = [tg.create_task(self.__process_file(request, blob)) for blob in blobs]
-        logger.info(f"Processing files ended")
-        
-        return [t.result() for t in tasks]
+    async def process_file(self, request: ProcessFileRequest, cancel: Optional[asyncio.Event] = None) -> EntityStore:
+        """
+        Process a single file of a load, used when the load is fanned out in one message per file.
+        If the load is cancelled before the file ends it is returned as CANCELLED
+        """
+        self.__init_limits()
+        if cancel is not None and cancel.is_set():
+            return self.__error_store(request, request.gs_path, None, status="CANCELLED")
+        blob = await self.bucket_service.get_blob(request.gs_path)
+        if blob is None:
+            logger.warning(f"File {request.gs_path} not found, it was deleted after the listing")
+            return self.__error_store(request, request.gs_path, None)
+        await self.file_window.acquire()
+        if cancel is None:
+            return await self.__process_file(request, blob)
+        task = asyncio.create_task(self.__process_file(request, blob))
+        waiter = asyncio.create_task(cancel.wait())
+        try:
+            await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                logger.info(f"File {request.gs_path} cancelled in progress")
+                return self.__error_store(request, request.gs_path, None, status="CANCELLED")
+            return task.result()
+        finally:
+            task.cancel()
+            waiter.cancel()
+
+    async def iter_load_files(self, gs_path: str) -> AsyncIterator[Blob]:
+        """
+        Lists the files of a load to fan it out, every file has to be referenced
+        by a blob so here the zips are always flattened in the bucket
+        """
+        admitted = set()
+        async for page in self.bucket_service.iter_blob_pages(gs_path):
+            for blob in page:
+                if blob.name in admitted:
+                    continue
+                files = await self.bucket_service.flatten_zip(blob) if blob.name.endswith(".zip") else [blob]
+                for file in files:
+                    admitted.add(file.name)
+                    yield file
+
+    async def __admit_files(self, tg: asyncio.TaskGroup, request: ProcessRequest, tasks: dict[str, asyncio.Task]):
+        # The zip members are placed under the same gs path, so the listing could return them again
+        admitted = set(request.done_files)
+        async for page in self.bucket_service.iter_blob_pages(request.gs_path):
+            for blob in page:
+                if blob.name in admitted:
+                    continue
+                if blob.name.endswith(".zip"):
+                    await self.__admit_zip(tg, request, blob, admitted, tasks)
+                    continue
+                await self.file_window.acquire()
+                admitted.add(blob.name)
+                tasks[blob.name] = tg.create_task(self.__process_file(request, blob))
+                self.__progress(blob.name, "QUEUED")
+        logger.info(f"Listing ended, {len(tasks)} files admitted to the batch")
+
+    @staticmethod
+    async def __stop_on_drain(drain: Drain, listing: asyncio.Task, tasks: dict[str, asyncio.Task]):
+        """
+        Stops the listing when the drain starts, the files in progress are cancelled if they don't end in time
+        """
+        await drain.wait()
+        listing.cancel()
+        pending = [task for task in tasks.values() if not task.done()]
+        if pending:
+            logger.warning(f"Draining, waiting {drain.remaining():.1f}s for {len(pending)} files in progress")
+            await asyncio.wait(pending, timeout=drain.remaining())
+        for task in pending:
+            task.cancel()
+
+    @staticmethod
+    async def __stop_on_cancel(cancel: asyncio.Event, listing: asyncio.Task, tasks: dict[str, asyncio.Task]):
+        """
+        Stops the listing and the files in progress when the load is cancelled, their slots are released on the way out
+        """
+        await cancel.wait()
+        listing.cancel()
+        for task in tasks.values():
+            task.cancel()
+
+    def __emit(self, name: str, entity: EntityStore):
+        if self.on_result:
+            self.on_result(name, entity)
+        self.__progress(name, entity.log.status)
+        return entity
+
+    def __progress(self, name: str, state: str):
+        if self.on_progress:
+            self.on_progress(name, state)
+
+    def __init_limits(self):
+        # Downloads and gemini calls are limited across every load of the instance
+        self.download_semaphore = get_download_limit()
+        self.processing_semaphore = get_gemini_limit()
+        # Files listed but not processed yet, while the window is full no more pages are listed
+        self.file_window = asyncio.Semaphore(self.config.max_files_in_flight)
+        # Bounds the decompressed zip members held in memory when the zips are expanded in memory
+        self.member_slots = asyncio.Semaphore(self.config.zip_max_members_in_memory)
+
+    async def _preprocess(self, zip_blob: Blob) -> AsyncIterator[Blob | PartFile]:
+        """
+        Preprocess a zip found in the batch so its files could be processed with the rest,
+        right now the zips are flattened in the bucket and the extracted blobs are yielded.
+        With zip_in_memory the zip is not flattened, its members are yielded as they are
+        decompressed so they go straight to the processing pipeline
+        """
+        if not self.config.zip_in_memory:
+            extracted = await self.bucket_service.flatten_zip(zip_blob)
+            for blob in extracted:
+                yield blob
+            return
+        async for member in self.bucket_service.expand_zip(zip_blob):
+            yield member
 
-    async def _preprocess(self, gs_path: str):
+    async def __admit_zip(self, tg: asyncio.TaskGroup, request: ProcessRequest, zip_blob: Blob, admitted: set[str],
+                          tasks: dict[str, asyncio.Task]):
         """
-        Preprocess the batch of files, this method is in charge of preparing the gs path so
-        the all the files there could be processed in batch, right now the only preprocess
-        to be done is to flatten the zips
+        Schedules the files of a zip, a decompressed member only leaves the zip when there is
+        room for it in the file window and in the member slots
         """
-        await self.bucket_service.flatten_bucket(gs_path)
+        files = self._preprocess(zip_blob)
+        while True:
+            await self.file_window.acquire()
+            await self.member_slots.acquire()
+            file = await anext(files, None)
+            if file is None:
+                self.member_slots.release()
+                self.file_window.release()
+                return
+            name = file.name if isinstance(file, Blob) else file.path.split("/", 3)[3]
+            if name in admitted:
+                # Finished before a drain interrupted the load
+                self.member_slots.release()
+                self.file_window.release()
+                continue
+            admitted.add(name)
+            if isinstance(file, Blob):
+                # Flattened in the bucket, downloaded when processed like any other file
+                self.member_slots.release()
+                tasks[name] = tg.create_task(self.__process_file(request, file))
+            else:
+                tasks[name] = tg.create_task(self.__process_member(request, file, name))
+            self.__progress(name, "QUEUED")
 
-    async def __process_file(self, request: ProcessRequest, blob: Blob):
+    async def __process_file(self, request: ProcessRequest | ProcessFileRequest, blob: Blob):
         """
         Process a single file manages the possible exceptions, etc
         """
-        
-        # Initialize log variable to avoid UnboundLocalError in exception handler
-        log = None
+        try:
+            return self.__emit(blob.name, await self.__download_and_process(request, blob))
+        finally:
+            self.file_window.release()
 
+    async def __download_and_process(self, request: ProcessRequest | ProcessFileRequest, blob: Blob):
         try:
             if blob.size > MAX_FILE_SIZE:
                 logger.warning(f"Blob exceed max file size {blob.name}, ignoring")
                 raise
 
-            # GCP bucket api is blocking, avoid blocking the main thread
+            # GCP bucket api is blocking, the download runs in the transfer executor
             async with self.download_semaphore:
+                self.__progress(blob.name, "DOWNLOADING")
+                inspection, data = await self.bucket_service.inspect(blob) if self.config.preflight else (None, None)
+                if inspection is not None and (problem := self.__rejection(inspection)):
+                    logger.warning(f"File {blob.name} rejected before downloading it: {problem}")
+                    return self.__error_store(request, blob.name, None)
                 try:
-                    file = await asyncio.get_running_loop().run_in_executor(None, get_file_from_storage, blob)
+                    file = await self.bucket_service.download(blob, data)
+                    file.inspection = inspection
                 except ValueError as ve:
                     logger.warning(f"File validation error for {blob.name}: {ve}")
                     raise ve
                 except Exception as e:
                     logger.error(f"Error downloading/processing file {blob.name}: {e}")
                     raise e
-
-            # gemini and the db provide async interfaces but limit them to avoid killing the main thread
-            async with self.processing_semaphore:
-                try:
-                    gemini_doc_type = await self.__get_doc_type(file, request.doc_type)
-                except ClientError as ce:
-                    logger.error(f"Gemini API error for file {file.original_filename}: {ce.status_code} {ce.message}")
-                    logger.error(f"File details - name: {file.original_filename}, size: {blob.size}, mime_type: {file.part.mime_type}")
-                    raise ce
-                except Exception as e:
-                    logger.error(f"Unexpected error during document type detection for {file.original_filename}: {e}")
-                    raise e
-                is_invalid = gemini_doc_type == "uncategorized"
-                if is_invalid:
-                    # In the original code an invalid doc stopped the execution but a mismatched one didn't
-                    logger.warning(f"The file {file.original_filename} could not be categorized, ignoring...")
-                    raise
-                temp_gemini_doc_type = gemini_doc_type
-                if (temp_gemini_doc_type[:5]== 'Saldo'): #To parse saldo fiduciario and saldo bancario
-                    temp_gemini_doc_type = 'Saldo'
-                log = Log(
-                    name=file.original_filename,
-                    status="PROCESSING",
-                    # processing pass to be an inner state here, due to the front not being able to check the 'loading status in this state'
-                    format=request.doc_type,
-                    parent_file=file.parent_file,
-                    identified_format=temp_gemini_doc_type,
-                    invalid_format=is_invalid
-                )
-                entity, validation = await self.__analyze_document(file=file, doc_type=gemini_doc_type)
-                log.status = "PROCESSED"
-                return EntityStore(load_id=request.load_id, entity=entity, validation=ValidationError(check_fields=validation) if validation else None, log=log)
         except Exception as e:
             logger.exception(f"Error processing file {blob.name}")
+            self.__note_failure(blob.name, e)
+            return self.__error_store(request, blob.name, None)
+
+        return await self.__process_part(request, file, blob.name)
+
+    async def __process_member(self, request: ProcessRequest, file: PartFile, name: str):
+        """
+        Process a zip member expanded in memory, the file is already downloaded so it goes
+        directly to gemini, its slot is released when done so the next member can be decompressed
+        """
+        try:
+            return self.__emit(name, await self.__process_part(request, file, name))
+        finally:
+            self.member_slots.release()
+            self.file_window.release()
+
+    async def __process_part(self, request: ProcessRequest | ProcessFileRequest, file: PartFile, name: str):
+        # Initialize log variable to avoid UnboundLocalError in exception handler
+        log = None
+
+        try:
+            if self.config.preflight and not await self.__preflight(file, name):
+                return self.__error_store(request, name, file.parent_file)
+            optimized = await self.__optimize(file, name)
+            self.__progress(name, "PROCESSING")
+            digest = await asyncio.to_thread(lambda: hashlib.sha256(file.part.inline_data.data).hexdigest())
+            try:
+                gemini_doc_type, _ = await documents.do(
+                    ("classify", digest, request.doc_type), lambda: self.__limited(self.__get_doc_type, file, request.doc_type))
+            except ClientError as ce:
+                logger.error(f"Gemini API error for file {file.original_filename}: {ce.status_code} {ce.message}")
+                logger.error(f"File details - name: {file.original_filename}, size: {len(file.part.inline_data.data)}, mime_type: {file.part.inline_data.mime_type}")
+                raise ce
+            except Exception as e:
+                logger.error(f"Unexpected error during document type detection for {file.original_filename}: {e}")
+                raise e
+            is_invalid = gemini_doc_type == "uncategorized"
+            if is_invalid:
+                # In the original code an invalid doc stopped the execution but a mismatched one didn't
+                logger.warning(f"The file {file.original_filename} could not be categorized, ignoring...")
+                raise
+            temp_gemini_doc_type = gemini_doc_type
+            if (temp_gemini_doc_type[:5]== 'Saldo'): #To parse saldo fiduciario and saldo bancario
+                temp_gemini_doc_type = 'Saldo'
+            log = Log(
+                name=file.original_filename,
+                status="PROCESSING",
+                # processing pass to be an inner state here, due to the front not being able to check the 'loading status in this state'
+                format=request.doc_type,
+                parent_file=file.parent_file,
+                identified_format=temp_gemini_doc_type,
+                invalid_format=is_invalid
+            )
+            if optimized is not None:
+                self.payload_savings.setdefault(temp_gemini_doc_type, PayloadSavings()).add(optimized)
+            (entity, validation, escalated), shared = await documents.do(
+                ("analyze", digest, gemini_doc_type), lambda: self.__limited(self.__analyze_document, file=file, doc_type=gemini_doc_type))
+            if shared:
+                logger.info(f"File {name} is identical to one in progress, its analysis was reused")
+            entity = self.__own_entity(entity, file)
+            if escalated is not None:
+                stats = self.cascade_stats.setdefault(gemini_doc_type, CascadeStats())
+                stats.files += 1
+                stats.escalated += escalated
+            log.status = "PROCESSED"
+            return EntityStore(load_id=request.load_id, entity=entity, validation=ValidationError(check_fields=validation) if validation else None, log=log)
+        except Exception as e:
+            logger.exception(f"Error processing file {name}")
+            self.__note_failure(name, e)
             # Create log entry if it doesn't exist yet
             if log is None:
-                log = Log(
-                    name=blob.name,
-                    status="ERROR",
-                    format=request.doc_type,
-                    parent_file=getattr(file, 'parent_file', None) if 'file' in locals() else None,
-                    identified_format=None,
-                    invalid_format=True
-                )
-            else:
-                log.status = "ERROR"
+                return self.__error_store(request, name, file.parent_file)
+            log.status = "ERROR"
             return EntityStore(load_id=request.load_id, log=log)
 
+    async def __limited(self, fn: Callable[..., Awaitable], *args, **kwargs):
+        """
+        gemini and the db provide async interfaces but limit them to avoid killing the main thread.
+        Only the call shared by identical files takes a slot, the files waiting on it don't hold one
+        """
+        async with self.processing_semaphore:
+            return await fn(*args, **kwargs)
+
+    async def __preflight(self, file: PartFile, name: str) -> bool:
+        """
+        Inspects the files that were not inspected before the download (zip members) and checks the end
+        of the images in the whole file, rejects the bad ones before any gemini call and sends the good
+        ones with the type of their content
+        """
+        data = file.part.inline_data.data
+        if file.inspection is None:
+            file.inspection = await asyncio.to_thread(inspect_content, data[:HEAD_SIZE], data[-TAIL_SIZE:], len(data))
+        if not file.inspection.problem and await asyncio.to_thread(truncated_image, data, file.inspection.mime_type):
+            file.inspection.problem = f"truncated {file.inspection.mime_type}"
+        problem = self.__rejection(file.inspection)
+        if problem:
+            logger.warning(f"File {name} rejected by the pre-flight inspection: {problem}")
+            return False
+        if file.part.inline_data.mime_type != file.inspection.mime_type:
+            logger.info(f"File {name} is a {file.inspection.mime_type} despite its extension, sent as such")
+            file.part = Part.from_bytes(data=data, mime_type=file.inspection.mime_type)
+        return True
+
+    async def __optimize(self, file: PartFile, name: str) -> OptimizedPayload | None:
+        """
+        Replaces the payload of a big file with its optimized version in the process pool, so every gemini
+        call of the file sends the lighter one. On any error the file is sent as it is
+        """
+        data = file.part.inline_data.data
+        if not self.config.optimize_payloads or len(data) < self.config.optimize_min_size or not optimization_available():
+            return None
+        try:
+            optimized = await asyncio.get_running_loop().run_in_executor(
+                get_optimize_executor(), optimize_payload, data, file.part.inline_data.mime_type,
+                self.config.optimize_max_dpi, self.config.optimize_jpeg_quality)
+        except Exception:
+            logger.warning(f"Error optimizing {name}, sending it as is", exc_info=True)
+            return None
+        if optimized is None:
+            return None
+        file.part = Part.from_bytes(data=optimized.data, mime_type=optimized.mime_type)
+        if file.inspection is not None and file.inspection.pages:
+            file.inspection.pages -= optimized.dropped_pages
+        logger.info(f"Optimized {name}: {optimized.original_size / 1e6:.1f}MB -> {len(optimized.data) / 1e6:.1f}MB, "
+                    f"{optimized.dropped_pages} blank pages dropped")
+        return optimized
+
+    def __report_savings(self, request: ProcessRequest):
+        if not self.payload_savings:
+            return
+        by_type = ", ".join(f"{doc_type}: {s.files} files {s.bytes_saved / 1e6:.1f}MB ~{s.tokens_saved} tokens"
+                            for doc_type, s in self.payload_savings.items())
+        logger.info(f"Load {request.load_id} payload optimization saved {by_type}")
+
+    def __report_cascade(self, request: ProcessRequest):
+        if not self.cascade_stats:
+            return
+        by_type = ", ".join(f"{doc_type}: {s.escalated} of {s.files} ({s.escalated / s.files:.0%})"
+                            for doc_type, s in self.cascade_stats.items())
+        logger.info(f"Load {request.load_id} cascade escalated {by_type}")
+
+    def __rejection(self, inspection: FileInspection) -> str | None:
+        if inspection.problem:
+            return inspection.problem
+        if inspection.encrypted and self.config.preflight_reject_encrypted:
+            return "encrypted pdf"
+        max_pages = self.config.preflight_max_pages
+        if max_pages and inspection.pages and inspection.pages > max_pages:
+            return f"{inspection.pages} pages, MAX: {max_pages}"
+        return None
+
+    @staticmethod
+    def __own_entity(entity, file: PartFile):
+        """
+        The analysis can be shared by identical files, each one gets its own copy of the entity with the
+        data that comes from the file itself and not from its content
+        """
+        if entity is None:
+            return None
+        entity = entity.model_copy(update={'filename': file.path}, deep=True)
+        # If balanceDate is empty, try to extract it from the filename using analytical_helper_service
+        if isinstance(entity, Balance) and not entity.balanceDate:
+            extracted_date = AnalyticalHelperService().extract_date_from_filename(file)
+            if extracted_date:
+                entity = Balance.model_validate({**entity.model_dump(), 'balanceDate': extracted_date})
+        return entity
+
+    def __note_failure(self, name: str, error: Exception):
+        if is_transient(error):
+            self.transient_failures.add(name)
+
+    @staticmethod
+    def __error_store(request: ProcessRequest | ProcessFileRequest, name: str, parent_file: Optional[str], status: str = "ERROR"):
+        log = Log(
+            name=name,
+            status=status,
+            format=request.doc_type,
+            parent_file=parent_file,
+            identified_format="uncategorized",
+            invalid_format=True
+        )
+        return EntityStore(load_id=request.load_id, log=log)
+
 
     async def __analyze_document(self, file: PartFile, doc_type: str):
 
@@ -159,10 +505,8 @@ class ProcessService:
         """
         config: Dict[str, Any] = DOCUMENT_CONFIG[doc_type]
         try:
-            with open(config['prompt_path'], "r", encoding='utf-8') as f:
-                extraction_prompt: str = f.read()
-            with open(config['audit_path'], "r", encoding='utf-8') as f:
-                audit_prompt_template: str = f.read()
+            extraction_prompt: str = load_prompt(config['prompt_path'])
+            audit_prompt_template: str = load_prompt(config['audit_path'])
 
         except FileNotFoundError as e:
             logger.error(f"No se encontró el archivo de prompt: {e}", exc_info=True)
@@ -171,49 +515,11 @@ class ProcessService:
             logger.error(f"Error leyendo archivos de prompt: {e}", exc_info=True)
             raise RuntimeError
 
-        extracted_data_df = await self.__extract_info_from_doc(file=file, prompt=extraction_prompt, doc_type=doc_type)
-        if extracted_data_df is None or extracted_data_df.empty:
-            logger.warning(
-                f"No se pudieron extraer datos o el DataFrame está vacío para {file.original_filename}.")
-            raise RuntimeError("")
-        try:
-            df_json_text: str = extracted_data_df.to_json(orient='records', indent=2, date_format="iso", force_ascii=False)
-            full_audit_prompt: str = audit_prompt_template.format(df_data=df_json_text)
-            audit_response_text = await self.model_service.make_prompt(full_audit_prompt)
-            audit_result: Dict[str, Any] = gemini_json_parse(audit_response_text.text)
-            # Construir diccionario de validación con campos que tengan score < 1
-            validation_data = {}
-            scores = audit_result.get("scores", {})
-            explanation_text = audit_result.get("explicacion", "")
-
-            for field, score in scores.items():
-                if isinstance(score, (int, float)) and score < 1:
-                    field_msg = None
-                    match = re.search(rf"({field}[^.,;\n]*)", explanation_text, re.IGNORECASE)
-                    if match:
-                        field_msg = match.group(1).strip()
-                    validation_data[field] = field_msg  # None si no se encontró explicación
-    
-
-            score_calculator_func: Optional[Callable[[Dict[str, float]], float]] = config['score_calculator']
-            scores_dict: Dict[str, float] = audit_result.get('scores', {})
-
-            result = score_calculator_func(scores_dict)
-        except:
-            logger.info("JSON muy largo para auditar, asignando score 70")
-            result: tuple = 0.7, "JSON muy largo para auditar, score asignado automaticamente"
-            validation_data = None
-        if isinstance(result, tuple) and len(result) == 2:
-            score_val, score_expl = result
+        escalated = None # whether the cascade escalated the document, None out of cascade mode
+        if self.config.cascade and config.get('cascade_threshold') is not None:
+            (extracted_data_df, validation_data), escalated = await self.__cascade(file, doc_type, extraction_prompt, audit_prompt_template)
         else:
-            score_val = result
-            score_expl = ''
-
-        extracted_data_df['score'] = [score_val]  
-        try:
-            extracted_data_df['score_explaining'] = audit_result.get('explicacion', '') + " | " + score_expl
-        except:
-            extracted_data_df['score_explaining'] = score_expl
+            extracted_data_df, validation_data = await self.__extract_and_audit(file, doc_type, extraction_prompt, audit_prompt_template)
 
         
         for col in config['base_columns']:
@@ -278,14 +584,88 @@ class ProcessService:
             case 'Email':
                 entity = Email(**d)
             case 'Saldo':
-                # If balanceDate is empty, try to extract it from the filename using analytical_helper_service
-                if not d.get("balanceDate"):
-                    helper = AnalyticalHelperService()
-                    extracted_date = helper.extract_date_from_filename(file)
-                    if extracted_date:
-                        d["balanceDate"] = extracted_date
+                # balanceDate missing is taken from the filename in __own_entity, the analysis can be shared by files
                 entity = Balance(**d)
-        return entity, validation_data if validation_data else None
+        return entity, validation_data if validation_data else None, escalated
+
+    async def __cascade(self, file: PartFile, doc_type: str, extraction_prompt: str, audit_prompt_template: str):
+        """
+        Extracts with the cascade model first and again with the escalate one only when that extraction
+        fails or its score is under the threshold of the doc type, the best scored of both is kept.
+        Returns the extraction and whether it was escalated
+        """
+        threshold = DOCUMENT_CONFIG[doc_type]['cascade_threshold']
+        first = score = None
+        try:
+            first = await self.__extract_and_audit(file, doc_type, extraction_prompt, audit_prompt_template, 'cascade')
+            score = normalized_score(first[0]['score'].iloc[0], doc_type)
+            if score >= threshold:
+                return first, False
+            reason = f"score {score:.0f}, MIN: {threshold}"
+        except Exception as e:
+            reason = f"extraction failed: {e}"
+        logger.info(f"Escalating {file.original_filename} ({doc_type}) to the stronger model, {reason}")
+        try:
+            second = await self.__extract_and_audit(file, doc_type, extraction_prompt, audit_prompt_template, 'escalate')
+        except Exception:
+            if first is None:
+                raise
+            logger.warning(f"Escalated extraction of {file.original_filename} failed, keeping the first one", exc_info=True)
+            return first, True
+        if first is not None and normalized_score(second[0]['score'].iloc[0], doc_type) < score:
+            return first, True
+        return second, True
+
+    async def __extract_and_audit(self, file: PartFile, doc_type: str, extraction_prompt: str, audit_prompt_template: str,
+                                  stage: str = 'extract'):
+        """
+        Extracts the document with the model of the stage and scores the extraction with the audit
+        """
+        config: Dict[str, Any] = DOCUMENT_CONFIG[doc_type]
+        extracted_data_df = await self.__extract_info_from_doc(file=file, prompt=extraction_prompt, doc_type=doc_type, stage=stage)
+        if extracted_data_df is None or extracted_data_df.empty:
+            logger.warning(
+                f"No se pudieron extraer datos o el DataFrame está vacío para {file.original_filename}.")
+            raise RuntimeError("")
+        try:
+            df_json_text: str = extracted_data_df.to_json(orient='records', indent=2, date_format="iso", force_ascii=False)
+            full_audit_prompt: str = audit_prompt_template.format(df_data=df_json_text)
+            audit_response_text = await self.model_service.make_prompt(full_audit_prompt, 'audit', doc_type)
+            audit_result: Dict[str, Any] = gemini_json_parse(audit_response_text.text)
+            # Construir diccionario de validación con campos que tengan score < 1
+            validation_data = {}
+            scores = audit_result.get("scores", {})
+            explanation_text = audit_result.get("explicacion", "")
+
+            for field, score in scores.items():
+                if isinstance(score, (int, float)) and score < 1:
+                    field_msg = None
+                    match = re.search(rf"({field}[^.,;\n]*)", explanation_text, re.IGNORECASE)
+                    if match:
+                        field_msg = match.group(1).strip()
+                    validation_data[field] = field_msg  # None si no se encontró explicación
+    
+
+            score_calculator_func: Optional[Callable[[Dict[str, float]], float]] = config['score_calculator']
+            scores_dict: Dict[str, float] = audit_result.get('scores', {})
+
+            result = score_calculator_func(scores_dict)
+        except Exception:
+            logger.info("JSON muy largo para auditar, asignando score 70")
+            result: tuple = 0.7, "JSON muy largo para auditar, score asignado automaticamente"
+            validation_data = None
+        if isinstance(result, tuple) and len(result) == 2:
+            score_val, score_expl = result
+        else:
+            score_val = result
+            score_expl = ''
+
+        extracted_data_df['score'] = [score_val]  
+        try:
+            extracted_data_df['score_explaining'] = audit_result.get('explicacion', '') + " | " + score_expl
+        except Exception:
+            extracted_data_df['score_explaining'] = score_expl
+        return extracted_data_df, validation_data
 
     async def __get_doc_type(self, file: PartFile, doc_type: str):
         """
@@ -293,8 +673,7 @@ class ProcessService:
         """
         known_categories = DOCUMENT_CONFIG.keys()
         try:
-            with open(CATEGORY_PROMPT_PATH, "r", encoding="utf-8") as f:
-                prompt_template = f.read()
+            prompt_template = load_prompt(CATEGORY_PROMPT_PATH)
         except FileNotFoundError:
             logger.exception(f"No se encontró el archivo de prompt de categorías en {CATEGORY_PROMPT_PATH}")
 
@@ -303,7 +682,7 @@ class ProcessService:
             for cat, conf in DOCUMENT_CONFIG.items()
         )
         prompt = prompt_template.format(category_descriptions=category_descriptions)
-        response = await self.model_service.make_prompt_with_file(prompt, file.part)
+        response = await self.model_service.make_prompt_with_file(prompt, file.part, 'classify')
         determined_category = response.text.strip()
         for valid_cat in known_categories:
             if determined_category.upper() == valid_cat.upper():
@@ -315,11 +694,12 @@ class ProcessService:
         return "uncategorized"
 
 
-    async def __extract_info_from_doc(self, file: PartFile, prompt: str, doc_type: str) -> pd.DataFrame:
+    async def __extract_info_from_doc(self, file: PartFile, prompt: str, doc_type: str, stage: str = 'extract') -> "pd.DataFrame":
         """
         Based on the original code by Andres
         """
-        mres = await self.model_service.make_prompt_with_file(prompt, file.part)
+        import pandas as pd
+        mres = await self.model_service.make_prompt_with_file(prompt, file.part, stage, doc_type)
         res = mres.text
         try:
             extracted_data = gemini_json_parse(res)
@@ -0,0 +1,135 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+from google.cloud.storage import Blob
+
+from app.dependencies import get_settings
+
+logger = logging.getLogger("uvicorn.error")
+STALE_WRITE_AGE = 60 * 60 # temp files older than this are from an interrupted write, not one in progress
+
+
+@lru_cache()
+def get_blob_cache():
+    """
+    Process wide cache of downloaded blobs, None if blob_cache_dir is not set
+    """
+    config = get_settings()
+    if not config.blob_cache_dir:
+        return None
+    return BlobCache(config.blob_cache_dir, config.blob_cache_max_bytes)
+
+
+class BlobCache:
+    """
+    Downloaded blobs kept on local disk, so a file processed again (retries, redeliveries, reruns)
+    is read from disk instead of downloaded. The entries are addressed by bucket, name and generation
+    (or md5 when there is no generation), an overwritten blob is a new entry and the old one is evicted
+    eventually. Writes are atomic (temp file + rename) and the least used entries are deleted once the
+    cache goes over max_bytes.
+    Used from the transfer threads, the index is guarded by a lock
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.__dir = Path(directory)
+        self.__dir.mkdir(parents=True, exist_ok=True)
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[str, int] = OrderedDict()
+        self.__size = 0
+        self.__load_index()
+
+    def read(self, blob: Blob) -> bytes | None:
+        """
+        The content of the blob if it is cached, the whole file is read in memory
+        """
+        key = self.__key(blob)
+        if key is None:
+            return None
+        path = self.__dir / key
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            # Evicted, or deleted by another instance sharing the directory
+            with self.__lock:
+                self.__forget(key)
+            return None
+        except OSError:
+            logger.warning(f"Unreadable blob cache entry {path}, ignoring", exc_info=True)
+            return None
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+        try:
+            # Keeps the order of use for the index built on the next start
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def write(self, blob: Blob, data: bytes):
+        key = self.__key(blob)
+        if key is None or len(data) > self.__max_bytes:
+            return
+        path = self.__dir / key
+        temp = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.__dir, prefix=".", suffix=".tmp", delete=False) as file:
+                temp = file.name
+                file.write(data)
+            # Readers see the whole file or no file
+            os.replace(temp, path)
+        except OSError:
+            logger.warning(f"Error writing blob cache entry for {blob.name}", exc_info=True)
+            if temp:
+                Path(temp).unlink(missing_ok=True)
+            return
+        with self.__lock:
+            self.__forget(key)
+            self.__entries[key] = len(data)
+            self.__size += len(data)
+            self.__evict()
+
+    @staticmethod
+    def __key(blob: Blob) -> str | None:
+        version = blob.generation or blob.md5_hash
+        if version is None:
+            # Without a version an overwritten blob would be served stale
+            return None
+        return hashlib.sha256(f"{blob.bucket.name}/{blob.name}#{version}".encode()).hexdigest()
+
+    def __forget(self, key: str):
+        size = self.__entries.pop(key, None)
+        if size is not None:
+            self.__size -= size
+
+    def __evict(self):
+        while self.__size > self.__max_bytes and self.__entries:
+            key, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            (self.__dir / key).unlink(missing_ok=True)
+
+    def __load_index(self):
+        """
+        Entries left by a previous run, the least recently used first. Leftover temp files of an
+        interrupted write are deleted, the recent ones can be writes of another instance sharing the directory
+        """
+        files = []
+        for path in self.__dir.iterdir():
+            stat = path.stat()
+            if path.name.startswith("."):
+                if time.time() - stat.st_mtime > STALE_WRITE_AGE:
+                    path.unlink(missing_ok=True)
+                continue
+            files.append((stat.st_mtime, path.name, stat.st_size))
+        for _, key, size in sorted(files):
+            self.__entries[key] = size
+            self.__size += size
+        self.__evict()
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+
+MAX_CANCELLED = 1000 # loads remembered as cancelled, for the files of the load still queued
+CANCELLED_TTL = 6 * 60 * 60 # seconds a cancellation is remembered, the messages of the load still queued arrive before
+
+
+@lru_cache()
+def get_cancellations():
+    return CancellationRegistry()
+
+
+class CancellationRegistry:
+    """
+    Process wide registry of the loads being processed, by load id, so a load can be cancelled
+    from the api or the broker. Every place processing a load watches it with its own event, the
+    events are set through the loop that created them so a load can be cancelled from any thread.
+    A cancelled load is remembered for CANCELLED_TTL or until a new load with its id is accepted
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__watchers: dict[uuid.UUID, list[tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+        self.__cancelled: OrderedDict[uuid.UUID, float] = OrderedDict() # by cancel time
+
+    @contextmanager
+    def watch(self, load_id: uuid.UUID):
+        """
+        Yields the event set when the load is cancelled, must be used inside a running loop
+        """
+        watcher = (asyncio.get_running_loop(), asyncio.Event())
+        with self.__lock:
+            if self.__remembered(load_id):
+                watcher[1].set()
+            self.__watchers.setdefault(load_id, []).append(watcher)
+        try:
+            yield watcher[1]
+        finally:
+            with self.__lock:
+                watchers = self.__watchers[load_id]
+                watchers.remove(watcher)
+                if not watchers:
+                    del self.__watchers[load_id]
+
+    def cancel(self, load_id: uuid.UUID) -> bool:
+        """
+        Cancels the load, returns True if it was being processed in this instance
+        """
+        with self.__lock:
+            self.__cancelled[load_id] = time.monotonic()
+            self.__cancelled.move_to_end(load_id)
+            if len(self.__cancelled) > MAX_CANCELLED:
+                self.__cancelled.popitem(last=False)
+            watchers = list(self.__watchers.get(load_id, []))
+        for loop, event in watchers:
+            loop.call_soon_threadsafe(event.set)
+        return bool(watchers)
+
+    def is_cancelled(self, load_id: uuid.UUID) -> bool:
+        with self.__lock:
+            return self.__remembered(load_id)
+
+    def forget(self, load_id: uuid.UUID):
+        """
+        Called when a new load is accepted, a load resubmitted with the id of a cancelled one is not cancelled
+        """
+        with self.__lock:
+            self.__cancelled.pop(load_id, None)
+
+    def __remembered(self, load_id: uuid.UUID) -> bool:
+        cancelled_at = self.__cancelled.get(load_id)
+        if cancelled_at is None:
+            return False
+        if time.monotonic() - cancelled_at > CANCELLED_TTL:
+            del self.__cancelled[load_id]
+            return False
+        return True
@@ -0,0 +1,33 @@
+import asyncio
+
+
+class Drain:
+    """
+    Process wide shutdown signal. When the instance is stopped (SIGTERM on a deploy or a scale down)
+    the drain starts: no new work is started and the work in progress has until the deadline to end
+    """
+
+    def __init__(self):
+        self.__event = asyncio.Event()
+        self.__deadline: float | None = None
+
+    def start(self, grace_period: float):
+        if self.__event.is_set():
+            return
+        self.__deadline = asyncio.get_running_loop().time() + grace_period
+        self.__event.set()
+
+    @property
+    def draining(self) -> bool:
+        return self.__event.is_set()
+
+    async def wait(self):
+        await self.__event.wait()
+
+    def remaining(self) -> float:
+        """
+        Seconds left of the grace period
+        """
+        if self.__deadline is None:
+            return 0
+        return max(self.__deadline - asyncio.get_running_loop().time(), 0)
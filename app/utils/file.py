@@ -3,6 +3,17 @@ from typing import Optional
 from google.genai.types import Part
 from pydantic import BaseModel
 
+class FileInspection(BaseModel):
+    """
+    What the pre-flight inspection found in the header and trailer of a file, see app/utils/preflight.py
+    """
+    mime_type: str # sniffed from the content, not from the extension
+    size: int
+    pages: int | None = None # estimated, None when it can't be told without parsing the whole pdf
+    encrypted: bool = False # has an /Encrypt dict, whether it needs an open password or only an owner one is not known
+    problem: str | None = None # why the file can't be processed, eg corrupt or not an allowed type
+
+
 class PartFile(BaseModel):
     """
     This is a utility dataclass to hold a genai Part to make gemini calls from memory
@@ -11,4 +22,5 @@ class PartFile(BaseModel):
     part: Part
     path: str # gs path eg gs://bucket/folder/file.pdf
     original_filename: str #file.pdf
-    parent_file: Optional[str] #parent file of the app, in this context the file was inside a zip then eg: archive.zip
\ No newline at end of file
+    parent_file: Optional[str] #parent file of the app, in this context the file was inside a zip then eg: archive.zip
+    inspection: Optional[FileInspection] = None # set by the pre-flight stage
\ No newline at end of file
@@ -1,16 +1,26 @@
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud.storage import Blob
 from google.genai.types import Part
 from mimetypes import guess_type
+from app.utils.blob_cache import BlobCache
 from app.utils.file import PartFile
 
 
-def get_file_from_storage(blob: Blob) -> PartFile:
+def get_file_from_storage(blob: Blob, cache: BlobCache | None = None, data: bytes | None = None) -> PartFile:
     """
     This function downloads a blob from gcp and transforms it into a utility partfile
     dataclass so it can be sent directly for the genai api and hold metadata util in the context
-    of this app
+    of this app. With a cache the blob is only downloaded if it is not cached yet, with data
+    (the content already read by the pre-flight inspection) it is not downloaded
     """
-    file_bytes = blob.download_as_bytes()
+    if data is not None:
+        file_bytes = data
+    elif cache is None:
+        file_bytes = blob.download_as_bytes()
+    else:
+        file_bytes = cache.read(blob)
+        if file_bytes is None:
+            file_bytes = download_cacheable(blob, cache)
     parts = blob.name.split('/', 2)[1:]  # remove the origin folder and split the path
     if len(parts) == 2:
         # means the file has a 'folder'. In the context of the app the file was inside a zip
@@ -27,3 +37,16 @@ def get_file_from_storage(blob: Blob) -> PartFile:
         original_filename=filename,
         parent_file=f"{parent}.zip" if parent else None
     )
+
+
+def download_cacheable(blob: Blob, cache: BlobCache) -> bytes:
+    """
+    Downloads the generation listed, the one the cache entry is keyed by. If the blob was
+    overwritten since it was listed the current one is processed instead, without caching it
+    """
+    try:
+        file_bytes = blob.download_as_bytes(if_generation_match=blob.generation)
+    except PreconditionFailed:
+        return blob.download_as_bytes()
+    cache.write(blob, file_bytes)
+    return file_bytes
@@ -9,7 +9,7 @@ def gemini_json_parse(text: str):
     ```json
     {}
     ```
-    need to be parsed
+    need to be parsed, or as the bare json when it is asked for json
     """
     match = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", text, re.DOTALL)
     if match:
@@ -17,5 +17,11 @@ def gemini_json_parse(text: str):
             return json.loads(match.group(1))
         except json.JSONDecodeError:
             logger.exception("Malformed/unrecognized gemini response")
+    elif text.strip().startswith("{"):
+        # With response_mime_type application/json the json comes without the fence
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            logger.exception("Malformed/unrecognized gemini response")
 
     raise ValueError("Unable to parse gemini response, not match for regex search")
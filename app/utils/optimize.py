@@ -0,0 +1,148 @@
+import importlib.util
+import io
+import math
+from functools import lru_cache
+
+from pydantic import BaseModel
+
+PAGE_TOKENS = 258 # tokens gemini counts for each pdf page and each image tile
+IMAGE_TILE = 768 # images are split in tiles of this size, smaller than SMALL_IMAGE in both sides are one tile
+SMALL_IMAGE = 384
+PAGE_INCHES = 11.7 # long side of an A4 page, the size a photo of a document is printed at
+
+
+class OptimizedPayload(BaseModel):
+    data: bytes
+    mime_type: str
+    original_size: int
+    dropped_pages: int = 0
+    tokens_saved: int = 0
+
+    @property
+    def bytes_saved(self):
+        return self.original_size - len(self.data)
+
+
+class PayloadSavings(BaseModel):
+    files: int = 0
+    bytes_saved: int = 0
+    tokens_saved: int = 0 # estimated from the pages dropped and the image tiles saved
+
+    def add(self, optimized: OptimizedPayload):
+        self.files += 1
+        self.bytes_saved += optimized.bytes_saved
+        self.tokens_saved += optimized.tokens_saved
+
+
+@lru_cache()
+def available() -> bool:
+    """
+    The optimization needs pillow and pymupdf, optional dependencies only imported by the worker processes
+    """
+    return importlib.util.find_spec("PIL") is not None and importlib.util.find_spec("pymupdf") is not None
+
+
+def optimize_payload(data: bytes, mime_type: str, max_dpi: int, quality: int) -> OptimizedPayload | None:
+    """
+    Makes a pdf or an image lighter for gemini: the images above max_dpi are downscaled and
+    re-encoded as jpeg, metadata and thumbnails are stripped and blank pdf pages dropped.
+    None if the result is not smaller. CPU bound, runs in the optimize process pool
+    """
+    if mime_type == "application/pdf":
+        return _optimize_pdf(data, max_dpi, quality)
+    if mime_type in ("image/jpeg", "image/png"):
+        return _optimize_image(data, mime_type, max_dpi, quality)
+    return None
+
+
+def _optimize_image(data: bytes, mime_type: str, max_dpi: int, quality: int) -> OptimizedPayload | None:
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as original:
+        # The orientation is applied before dropping the exif that has it
+        image = ImageOps.exif_transpose(original)
+        before = _image_tokens(*image.size)
+        limit = int(PAGE_INCHES * max_dpi)
+        if max(image.size) > limit:
+            image.thumbnail((limit, limit), Image.LANCZOS)
+        out = io.BytesIO()
+        if mime_type == "image/jpeg":
+            image.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+        else:
+            image.save(out, "PNG", optimize=True)
+        after = _image_tokens(*image.size)
+    if out.tell() >= len(data):
+        return None
+    return OptimizedPayload(data=out.getvalue(), mime_type=mime_type, original_size=len(data), tokens_saved=before - after)
+
+
+def _image_tokens(width: int, height: int) -> int:
+    if width <= SMALL_IMAGE and height <= SMALL_IMAGE:
+        return PAGE_TOKENS
+    return math.ceil(width / IMAGE_TILE) * math.ceil(height / IMAGE_TILE) * PAGE_TOKENS
+
+
+def _optimize_pdf(data: bytes, max_dpi: int, quality: int) -> OptimizedPayload | None:
+    import pymupdf
+
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        if doc.needs_pass:
+            return None
+        blank = [page.number for page in doc if _is_blank(page)]
+        if len(blank) == doc.page_count:
+            # An all blank pdf is sent as is, the model tells it is not a document
+            blank = []
+        if blank:
+            doc.delete_pages(blank)
+        resized = set()
+        for page in doc:
+            if doc.xref_get_key(page.xref, "Thumb")[0] != "null":
+                doc.xref_set_key(page.xref, "Thumb", "null")
+            for xref, smask, width, *_ in page.get_images(full=True):
+                if xref in resized or smask:
+                    # Images with transparency would lose it as jpeg
+                    continue
+                rects = page.get_image_rects(xref)
+                shown_width = max((rect.width for rect in rects), default=0)
+                if not shown_width or width * 72 / shown_width <= max_dpi:
+                    continue
+                resized.add(xref)
+                page.replace_image(xref, stream=_downscale(doc, xref, max_dpi * shown_width / (72 * width), quality))
+        doc.set_metadata({})
+        doc.del_xml_metadata()
+        optimized = doc.tobytes(garbage=3, deflate=True, clean=True)
+    if len(optimized) >= len(data) and blank:
+        # Re-written it came out bigger, the blank pages are dropped from the original leaving its images as they were
+        optimized = _drop_pages(data, blank)
+    if len(optimized) >= len(data):
+        return None
+    return OptimizedPayload(data=optimized, mime_type="application/pdf", original_size=len(data),
+                            dropped_pages=len(blank), tokens_saved=len(blank) * PAGE_TOKENS)
+
+
+def _drop_pages(data: bytes, pages: list[int]) -> bytes:
+    import pymupdf
+
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        doc.delete_pages(pages)
+        return doc.tobytes(garbage=3, deflate=True)
+
+
+def _is_blank(page) -> bool:
+    return not page.get_text().strip() and not page.get_images() and not page.get_drawings()
+
+
+def _downscale(doc, xref: int, scale: float, quality: int) -> bytes:
+    import pymupdf
+    from PIL import Image
+
+    pixmap = pymupdf.Pixmap(doc, xref)
+    if pixmap.colorspace is None or pixmap.colorspace.n not in (1, 3):
+        pixmap = pymupdf.Pixmap(pymupdf.csRGB, pixmap)
+    if pixmap.alpha:
+        pixmap = pymupdf.Pixmap(pixmap, 0)
+    image = Image.frombytes("L" if pixmap.n == 1 else "RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality, optimize=True)
+    return out.getvalue()
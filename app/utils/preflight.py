@@ -0,0 +1,83 @@
+import re
+
+import magic
+from google.cloud.storage import Blob
+
+from app.utils.blob_cache import BlobCache
+from app.utils.file import FileInspection
+
+HEAD_SIZE = 4 * 1024 # magic bytes and the linearization dict of a linearized pdf
+TAIL_SIZE = 32 * 1024 # startxref, %%EOF and the trailer dict of a pdf, the end marker of an image
+MIME_TYPES = {"application/pdf", "image/png", "image/jpeg"} # same types as the allowed extensions
+IMAGE_END_MARKERS = {"image/png": b"IEND", "image/jpeg": b"\xff\xd9"}
+
+ENCRYPT = re.compile(rb"/Encrypt\b")
+LINEARIZED_PAGES = re.compile(rb"/Linearized\b.*?/N\s+(\d+)", re.DOTALL)
+PAGE_COUNT = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+
+
+def inspect_blob(blob: Blob, cache: BlobCache | None = None) -> tuple[FileInspection, bytes | None]:
+    """
+    Inspects a blob without downloading it: only its header and trailer are read with ranged requests.
+    Returns the content too when it was read whole, from the cache or because the file is small, so it
+    is not downloaded again. Blocking, runs in the transfer executor
+    """
+    data = cache.read(blob) if cache else None
+    if data is not None:
+        return inspect_content(data[:HEAD_SIZE], data[-TAIL_SIZE:], len(data)), data
+    if blob.size is None:
+        blob.reload()
+    size = blob.size
+    if size <= HEAD_SIZE + TAIL_SIZE:
+        # Small files in a single request
+        data = blob.download_as_bytes(if_generation_match=blob.generation)
+        if cache:
+            cache.write(blob, data)
+        return inspect_content(data[:HEAD_SIZE], data[-TAIL_SIZE:], len(data)), data
+    # The checksum is of the whole object, it can't be validated on a ranged read
+    head = blob.download_as_bytes(start=0, end=HEAD_SIZE - 1, if_generation_match=blob.generation, checksum=None)
+    tail = blob.download_as_bytes(start=size - TAIL_SIZE, if_generation_match=blob.generation, checksum=None)
+    return inspect_content(head, tail, size), None
+
+
+def inspect_content(head: bytes, tail: bytes, size: int) -> FileInspection:
+    """
+    Tells the type of a file from its first bytes and, for pdfs, whether it is encrypted, truncated
+    and how many pages it has when that can be found in the header or trailer. The page count of a pdf
+    with compressed object streams can't be read from there and is left unknown. Whether an image is
+    truncated is not told from its trailer, see truncated_image
+    """
+    if size == 0:
+        return FileInspection(mime_type="application/x-empty", size=0, problem="empty file")
+    mime_type = magic.from_buffer(head, mime=True)
+    inspection = FileInspection(mime_type=mime_type, size=size)
+    if mime_type not in MIME_TYPES:
+        inspection.problem = f"content is {mime_type}, not an allowed type"
+    elif mime_type == "application/pdf":
+        inspection.encrypted = bool(ENCRYPT.search(head) or ENCRYPT.search(tail))
+        inspection.pages = _pdf_pages(head, tail)
+        if b"%%EOF" not in tail or b"startxref" not in tail:
+            inspection.problem = "corrupt or truncated pdf, it has no trailer"
+        elif inspection.pages == 0:
+            inspection.problem = "pdf without pages"
+    else:
+        inspection.pages = 1
+    return inspection
+
+
+def truncated_image(data: bytes, mime_type: str) -> bool:
+    """
+    Whether a downloaded image has no end marker. It is searched in the whole file, phone photos carry
+    data after it (motion photo videos, vendor trailers) that can be bigger than the trailer inspected
+    """
+    end_marker = IMAGE_END_MARKERS.get(mime_type)
+    return end_marker is not None and end_marker not in data
+
+
+def _pdf_pages(head: bytes, tail: bytes) -> int | None:
+    linearized = LINEARIZED_PAGES.search(head)
+    if linearized:
+        return int(linearized.group(1))
+    # The root of the page tree has the count of the whole document, the other nodes less
+    counts = [int(a or b) for chunk in (head, tail) for a, b in PAGE_COUNT.findall(chunk)]
+    return max(counts) if counts else None
@@ -0,0 +1,11 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def load_prompt(path: str) -> str:
+    """
+    Prompts don't change while the app runs, they are read once per process
+    (at startup by the warm up) and kept in memory instead of opening the file on every call
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
@@ -0,0 +1,43 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Runs a coroutine once per key at a time: the callers arriving while it runs wait for the same
+    result (or exception) instead of starting it again. The call runs in its own task, a caller
+    going away (eg a client disconnecting) doesn't cancel it for the rest, it is only cancelled
+    when every caller went away
+    """
+
+    def __init__(self):
+        self.__calls: dict[Hashable, asyncio.Task] = {}
+        self.__waiters: dict[asyncio.Task, int] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """
+        Returns the result and whether it was shared with a call already in flight
+        """
+        task = self.__calls.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.__calls[key] = task
+            task.add_done_callback(lambda done: self.__forget(key, done))
+        self.__waiters[task] = self.__waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task), shared
+        finally:
+            self.__waiters[task] -= 1
+            if not self.__waiters[task]:
+                del self.__waiters[task]
+                # Forgotten right away, a caller arriving before the task ends starts a new call
+                # instead of joining the cancelled one
+                self.__forget(key, task)
+                task.cancel()
+
+    def __forget(self, key: Hashable, task: asyncio.Task):
+        if self.__calls.get(key) is task:
+            del self.__calls[key]
@@ -0,0 +1,39 @@
+import httpx
+import requests
+from google.api_core import exceptions as gcs_exceptions
+from google.auth.exceptions import TransportError
+from google.genai.errors import ClientError, ServerError
+
+# Status codes of gemini worth another attempt later, the rest of the 4xx fail the same way every time
+RETRYABLE_CLIENT_CODES = {408, 429}
+RETRYABLE_GCS_ERRORS = (
+    gcs_exceptions.TooManyRequests,
+    gcs_exceptions.InternalServerError,
+    gcs_exceptions.BadGateway,
+    gcs_exceptions.ServiceUnavailable,
+    gcs_exceptions.GatewayTimeout,
+    gcs_exceptions.DeadlineExceeded,
+)
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Tells if a file failed for something that could work on a later attempt: gemini rate limits
+    and 5xx, timeouts and connection errors of gemini or gcs. A document gemini can't read or
+    categorize is not transient, retrying it only spends quota
+    """
+    if error.__cause__ is not None and is_transient(error.__cause__):
+        return True
+    if isinstance(error, ClientError):
+        return error.code in RETRYABLE_CLIENT_CODES
+    return isinstance(error, (
+        ServerError,
+        *RETRYABLE_GCS_ERRORS,
+        TransportError,
+        httpx.TimeoutException,
+        httpx.TransportError,
+        requests.ConnectionError,
+        requests.Timeout,
+        TimeoutError,
+        ConnectionError,
+    ))
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import tempfile
+
+import magic
+from fastapi import HTTPException, Request
+from python_multipart import MultipartParser
+from python_multipart.multipart import parse_options_header
+
+SPOOL_MAX_SIZE = 1024 * 1024 # uploads bigger than this are written to disk while they are received
+SNIFF_SIZE = 2048 # bytes libmagic needs to recognize the type of a file
+MAX_FIELD_SIZE = 64 * 1024 # the other fields of the form are small values
+
+
+class SpooledUpload:
+    """
+    A file received from a multipart form, spooled while it was received and already checked.
+    The rest of the fields of the form are in fields
+    """
+
+    def __init__(self):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.filename: str | None = None
+        self.size = 0
+        self.head = b""
+        self.fields: dict[str, str] = {}
+
+    async def read(self) -> bytes:
+        return await asyncio.to_thread(self.__read)
+
+    async def sha256(self) -> str:
+        return await asyncio.to_thread(self.__sha256)
+
+    def close(self):
+        self.spool.close()
+
+    def __read(self) -> bytes:
+        self.spool.seek(0)
+        return self.spool.read()
+
+    def __sha256(self) -> str:
+        self.spool.seek(0)
+        digest = hashlib.sha256()
+        while chunk := self.spool.read(1024 * 1024):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+async def receive_upload(request: Request, file_field: str, max_size: int, signature: bytes, mime_type: str) -> SpooledUpload:
+    """
+    Parses the multipart body as it arrives instead of waiting for the whole upload: the file is
+    rejected as soon as its first bytes don't have the signature of the expected type or it goes
+    over max_size. Once received its type is confirmed with libmagic off the event loop
+    """
+    uploads, fields = await receive_uploads(request, file_field, max_size, signature, mime_type, max_files=1)
+    uploads[0].fields = fields
+    return uploads[0]
+
+
+async def receive_uploads(request: Request, file_field: str, max_size: int, signature: bytes, mime_type: str,
+                          max_files: int) -> tuple[list[SpooledUpload], dict[str, str]]:
+    """
+    Same as receive_upload for a form with up to max_files files in file_field, each one checked
+    on its own while it arrives. Returns the files in the order they were sent and the rest of the fields
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=422, detail="Body must be a multipart form")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size * max_files + MAX_FIELD_SIZE:
+        raise HTTPException(status_code=422, detail=f"File too large, MAX: {max_size / (1024 * 1024):.0f} MB")
+
+    uploads: list[SpooledUpload] = []
+    fields: dict[str, str] = {}
+    part = {}
+
+    def on_part_begin():
+        part.clear()
+        part["headers"] = {}
+        part["value"] = bytearray()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        part["field"] = part.get("field", b"") + data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        part["header_value"] = part.get("header_value", b"") + data[start:end]
+
+    def on_header_end():
+        part["headers"][part.pop("field", b"").lower()] = part.pop("header_value", b"")
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["name"] = disposition.get(b"name", b"").decode()
+        if part["name"] == file_field:
+            if len(uploads) == max_files:
+                raise HTTPException(status_code=422, detail=f"Too many files, MAX: {max_files}")
+            uploads.append(SpooledUpload())
+            uploads[-1].filename = disposition.get(b"filename", b"").decode() or None
+
+    def on_part_data(data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        if part["name"] != file_field:
+            part["value"] += chunk
+            if len(part["value"]) > MAX_FIELD_SIZE:
+                raise HTTPException(status_code=422, detail=f"Field {part['name']} too large")
+            return
+        upload = uploads[-1]
+        upload.size += len(chunk)
+        if upload.size > max_size:
+            raise HTTPException(status_code=422, detail=f"File too large, MAX: {max_size / (1024 * 1024):.0f} MB")
+        if len(upload.head) < SNIFF_SIZE:
+            previous = len(upload.head)
+            upload.head += chunk[:SNIFF_SIZE - previous]
+            if previous < len(signature) <= len(upload.head) and not upload.head.startswith(signature):
+                raise HTTPException(status_code=422, detail=f"File must be a valid {mime_type}")
+        upload.spool.write(chunk)
+
+    def on_part_end():
+        if part["name"] != file_field:
+            fields[part["name"]] = part["value"].decode()
+
+    parser = MultipartParser(options[b"boundary"], callbacks={
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+        if not uploads:
+            raise HTTPException(status_code=422, detail=f"Field {file_field} is required")
+        for upload in uploads:
+            if len(upload.head) < len(signature) or await asyncio.to_thread(magic.from_buffer, upload.head, mime=True) != mime_type:
+                raise HTTPException(status_code=422, detail=f"File must be a valid {mime_type}")
+    except BaseException:
+        for upload in uploads:
+            upload.close()
+        raise
+    return uploads, fields
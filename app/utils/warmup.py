@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import time
+import uuid
+
+from analyzers.document_config import DOCUMENT_CONFIG, CATEGORY_PROMPT_PATH
+from app.dependencies import get_settings, get_storage_client, get_genai_client, get_transfer_executor
+from app.dto.entity_store import EntityStore
+from app.dto.log import Log
+from app.services.bucket_service import get_bucket_service
+from app.services.model_service import GEMINI_MODEL
+from app.utils.blob_cache import get_blob_cache
+from app.utils.optimize import available as optimization_available
+from app.utils.prompt import load_prompt
+
+logger = logging.getLogger("uvicorn.error")
+
+
+async def warm_up():
+    """
+    Leaves a new instance ready before it takes the first message, otherwise the first document
+    of every instance pays for reading the prompts, building the clients, getting the auth tokens
+    and opening the connections. Everything here is best effort, an instance that fails to warm up
+    still works, it just pays that cost on the first document
+    """
+    start = time.perf_counter()
+    if get_settings().optimize_payloads and not optimization_available():
+        logger.warning("optimize_payloads is set but pillow or pymupdf are not installed, files are sent as they are")
+    for config in DOCUMENT_CONFIG.values():
+        load_prompt(config['prompt_path'])
+        load_prompt(config['audit_path'])
+    load_prompt(CATEGORY_PROMPT_PATH)
+
+    # Exercise the validation and serialization of what is published to the broker
+    EntityStore(
+        load_id=uuid.uuid4(),
+        log=Log(name="warmup", status="ERROR", format="CV", identified_format="CV", invalid_format=True)
+    ).model_dump_json()
+
+    results = await asyncio.gather(_prime_storage(), _prime_genai(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Warm up step failed, it will be done on the first document: {result}")
+    logger.info(f"Warm up finished in {time.perf_counter() - start:.2f}s")
+
+
+async def _prime_storage():
+    client = get_storage_client()
+    gs_path = get_settings().warmup_gs_path
+    if not gs_path:
+        return
+    # Listing a page validates and caches the bucket handle, gets the token and opens a pooled connection
+    bucket_service = get_bucket_service(get_settings(), get_transfer_executor(), client, get_blob_cache())
+    await anext(bucket_service.iter_blob_pages(gs_path), None)
+
+
+async def _prime_genai():
+    # Cheapest request to vertex, gets the token and opens the connection the first gemini call would open
+    await get_genai_client().aio.models.get(model=GEMINI_MODEL)
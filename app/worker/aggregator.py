@@ -0,0 +1,53 @@
+import logging
+import uuid
+from collections import OrderedDict
+
+from pydantic import BaseModel
+
+from app.dto.entity_store import EntityStore
+from app.dto.load import LoadEvent
+
+logger = logging.getLogger("uvicorn.error")
+MAX_COMPLETED = 1000 # loads remembered as completed, for their events redelivered or arriving late
+
+
+class LoadProgress(BaseModel):
+    tenant: str
+    expected: int | None = None # unknown until the listing ends
+    results: dict[str, EntityStore] = {} # by gs path, a redelivered file is only counted once
+
+
+class LoadAggregator:
+    """
+    Tracks the completion of the fanned out loads and gathers their results so the orchestrator
+    keeps receiving a single entity.store message per load.
+    The state is in memory, the loads queue has a single active consumer so every event of a load
+    reaches the same worker, if that worker dies the loads in progress are not completed
+    """
+
+    def __init__(self):
+        self.__loads: dict[uuid.UUID, LoadProgress] = {}
+        self.__completed: OrderedDict[uuid.UUID, None] = OrderedDict()
+
+    def add(self, event: LoadEvent, tenant: str) -> LoadProgress | None:
+        """
+        Registers the event, returns the load when the event completes it.
+        The events of a load already completed are ignored, they would start a load never completed
+        """
+        if event.load_id in self.__completed:
+            logger.info(f"Ignoring {event.kind} of load {event.load_id}, it was already completed")
+            return None
+        load = self.__loads.setdefault(event.load_id, LoadProgress(tenant=tenant))
+        match event.kind:
+            case 'listed':
+                load.expected = event.files
+            case 'file_done':
+                load.results[event.gs_path] = event.result
+        if load.expected is None or len(load.results) < load.expected:
+            return None
+        logger.info(f"Load {event.load_id} completed with {len(load.results)} files")
+        del self.__loads[event.load_id]
+        self.__completed[event.load_id] = None
+        if len(self.__completed) > MAX_COMPLETED:
+            self.__completed.popitem(last=False)
+        return load
@@ -1,44 +1,328 @@
+import asyncio
 import logging
+import uuid
 from typing import Annotated
 
 from fastapi.params import Depends
 from faststream.broker.fastapi.context import Context
-from faststream.exceptions import RejectMessage
+from faststream.exceptions import NackMessage, RejectMessage
 from faststream.rabbit import RabbitQueue, RabbitExchange, ExchangeType
 from faststream.rabbit.fastapi import RabbitRouter
 
 from app.dependencies import RMQSettings
-from app.dto.process import ProcessRequest
+from app.dto.entity_store import EntityStore
+from app.dto.ingest import ObjectFinalized, LoadClose
+from app.dto.load import LoadEvent
+from app.dto.process import ProcessRequest, ProcessFileRequest, CancelRequest
+from app.services.bucket_service import BucketService, get_bucket_service
 from app.services.process_service import ProcessService, get_process_service
+from app.utils.cancellation import get_cancellations
+from app.utils.drain import Drain
+from app.worker.aggregator import LoadAggregator
+from app.worker.ingest import IngestCoordinator, IngestingLoad
+from app.worker.publisher import ResultPublisher, UnpublishedResults
+from app.worker.retry import FileRetries
+from app.worker.scheduler import SchedulerClosed, TenantScheduler
 
 config = RMQSettings()
 logger = logging.getLogger("uvicorn.error")
-rmq_router = RabbitRouter(f"amqp://{config.rmq_user}:{config.rmq_pass}@{config.rmq_host}:{config.rmq_port}")
+DRAIN_PUBLISH_TIME = 3 # seconds after the drain deadline to publish the results and checkpoints
+rmq_router = RabbitRouter(
+    f"amqp://{config.rmq_user}:{config.rmq_pass}@{config.rmq_host}:{config.rmq_port}",
+    max_consumers=config.rmq_prefetch,
+    # On shutdown the broker stops consuming and waits this long for the handlers in progress
+    graceful_timeout=config.rmq_drain_timeout + DRAIN_PUBLISH_TIME,
+)
 exchange = RabbitExchange(
     "bloocheck",
     durable=True,
     type=ExchangeType.TOPIC
 )
+# Interactive loads can be published with a higher priority, only when the queues are declared with one
+priority_arguments = {"x-max-priority": config.rmq_max_priority} if config.rmq_max_priority else None
 queue = RabbitQueue(
     "bloocheck.docs",
     routing_key="process.init",
     robust=True,
     durable=True,
+    arguments=priority_arguments,
+)
+# Fan out: one message per file of a load, consumed by every worker
+files_queue = RabbitQueue(
+    "bloocheck.files",
+    routing_key="process.file",
+    robust=True,
+    durable=True,
+    arguments=priority_arguments,
 )
+# Fan out: files failed for a transient error coming back from their delay queue
+retry_queue = RabbitQueue(
+    "bloocheck.files.retry",
+    routing_key="process.file.retry",
+    robust=True,
+    durable=True,
+    arguments=priority_arguments,
+)
+# Fan out: progress of the loads, a single active consumer so every event of a load reaches the same aggregator
+loads_queue = RabbitQueue(
+    "bloocheck.loads",
+    routing_key="process.load.*",
+    robust=True,
+    durable=True,
+    arguments={"x-single-active-consumer": True},
+)
+# Ingestion: loads opened and closed by the orchestrator and the object notifications of the bucket,
+# a single active consumer so the loads and their notifications meet in the same coordinator
+ingest_queue = RabbitQueue(
+    "bloocheck.ingest",
+    routing_key="ingest.#",
+    robust=True,
+    durable=True,
+    arguments={"x-single-active-consumer": True},
+)
+# Cancellations reach every instance, each one has its own queue that is deleted when it stops
+cancel_queue = RabbitQueue(
+    f"bloocheck.cancel.{uuid.uuid4().hex}",
+    routing_key="process.cancel",
+    exclusive=True,
+    auto_delete=True,
+)
+aggregator = LoadAggregator()
+ingestion = IngestCoordinator()
+publisher = ResultPublisher(rmq_router.broker, exchange, config)
+scheduler = TenantScheduler(config)
+retries = FileRetries(rmq_router.broker, exchange, config)
+drain = Drain()
+cancellations = get_cancellations()
+# Retries wait behind any fresh message waiting in the worker
+RETRY_PRIORITY = -1
+
+
+@rmq_router.after_startup
+async def declare_retry_queues(app):
+    await retries.declare()
+
+
+@rmq_router.on_broker_shutdown
+async def start_drain(app):
+    """
+    Runs on SIGTERM before the broker stops. The messages waiting for a slot go back to the queue,
+    the loads in progress stop admitting files and send back what they couldn't finish
+    """
+    logger.info(f"Draining the worker, {config.rmq_drain_timeout}s for the files in progress")
+    drain.start(config.rmq_drain_timeout)
+    scheduler.close()
 
 
 @rmq_router.subscriber(queue=queue, exchange=exchange)
 #@rmq_router.publisher(routing_key="entity.store", exchange=exchange)
-async def process_docs(req: ProcessRequest, process_service: Annotated[ProcessService, Depends(get_process_service)], tenant: str = Context("message.headers.tenant", default=None)):
+async def process_docs(req: ProcessRequest, process_service: Annotated[ProcessService, Depends(get_process_service)], tenant: str = Context("message.headers.tenant", default=None), priority: int | None = Context("message.raw_message.priority", default=None)):
     # The tenant is received here, the process is agnostic to the tenant, that doesn't matter, the thing is
     # that the result HAS TO BE tied to a header so the orchestator has knowledge of the process which is tied to
     if not tenant:
         logger.error("Message dont have tenant header, cannot proceed")
         raise RejectMessage()
-    entities = await process_service.process_files(req)
+    emitted: list[tuple[str, EntityStore]] = []
+
+    def stream_result(name: str, entity: EntityStore):
+        emitted.append((name, entity))
+        publisher.submit(entity, tenant)
+
+    on_result = stream_result if config.rmq_stream_results else None
+    try:
+        async with scheduler.slot(tenant, priority or 0):
+            with cancellations.watch(req.load_id) as cancel:
+                if config.rmq_fan_out:
+                    await fan_out(req, process_service, tenant, priority, cancel)
+                    return
+                entities = await process_service.process_files(req, on_result=on_result, drain=drain, cancel=cancel)
+    except SchedulerClosed:
+        raise NackMessage()
+    if config.rmq_stream_results:
+        try:
+            await publisher.flush(tenant, req.load_id)
+        except UnpublishedResults as e:
+            if not process_service.interrupted:
+                logger.error(f"Load {req.load_id}: {e}, sending it back to the queue")
+                raise NackMessage()
+            # Sent back with the checkpoint, the files without their results published are processed again
+            unpublished = {id(entity) for entity in e.entities}
+            lost = {name for name, entity in emitted if id(entity) in unpublished}
+            logger.error(f"Load {req.load_id}: {e}, {len(lost)} files left out of the checkpoint")
+            process_service.finished_files = [name for name in process_service.finished_files if name not in lost]
+    elif entities or not process_service.interrupted:
+        await publisher.publish(entities, tenant)
+    if process_service.interrupted:
+        await checkpoint(req, process_service.finished_files, tenant, priority)
+
+
+async def checkpoint(req: ProcessRequest, finished_files: list[str], tenant: str, priority: int | None):
+    """
+    Sends the load interrupted by a drain back to process.init, the results of its finished
+    files were already published so the instance taking it only processes the rest
+    """
+    logger.info(f"Load {req.load_id} sent back with {len(finished_files)} more files finished")
+    await rmq_router.broker.publish(
+        message=req.model_copy(update={"done_files": req.done_files + finished_files}),
+        exchange=exchange,
+        routing_key="process.init",
+        headers={"tenant": tenant},
+        priority=priority,
+        persist=True,
+    )
+
+
+async def fan_out(req: ProcessRequest, process_service: ProcessService, tenant: str, priority: int | None, cancel: asyncio.Event):
+    """
+    Publishes every file of the load as a process.file message so the load is spread across
+    the workers, once the listing ends the aggregator is told how many files to wait for
+    """
+    files = 0
+    async for blob in process_service.iter_load_files(req.gs_path):
+        if cancel.is_set():
+            logger.info(f"Load {req.load_id} cancelled while fanning out, {files} files already published")
+            break
+        await rmq_router.broker.publish(
+            message=ProcessFileRequest(load_id=req.load_id, gs_path=f"gs://{blob.bucket.name}/{blob.name}", doc_type=req.doc_type),
+            exchange=exchange,
+            routing_key="process.file",
+            headers={"tenant": tenant},
+            priority=priority,
+        )
+        files += 1
+    logger.info(f"Load {req.load_id} fanned out in {files} files")
+    await rmq_router.broker.publish(
+        message=LoadEvent(load_id=req.load_id, kind="listed", files=files),
+        exchange=exchange,
+        routing_key="process.load.listed",
+        headers={"tenant": tenant}
+    )
+
+
+@rmq_router.subscriber(queue=files_queue, exchange=exchange)
+async def process_file(req: ProcessFileRequest, process_service: Annotated[ProcessService, Depends(get_process_service)], tenant: str = Context("message.headers.tenant", default=None), priority: int | None = Context("message.raw_message.priority", default=None)):
+    await handle_file(req, process_service, tenant, priority or 0, 0)
+
+
+@rmq_router.subscriber(queue=retry_queue, exchange=exchange)
+async def retry_file(req: ProcessFileRequest, process_service: Annotated[ProcessService, Depends(get_process_service)], tenant: str = Context("message.headers.tenant", default=None), attempt: int = Context("message.headers.attempt", default=1)):
+    await handle_file(req, process_service, tenant, RETRY_PRIORITY, attempt)
+
+
+async def handle_file(req: ProcessFileRequest, process_service: ProcessService, tenant: str, priority: int, attempt: int):
+    """
+    Processes a file of a fanned out load. A transient failure sends the file to be retried later
+    instead of reporting it, the load waits for it until it has no attempts left
+    """
+    if not tenant:
+        logger.error("Message dont have tenant header, cannot proceed")
+        raise RejectMessage()
+    try:
+        async with scheduler.slot(tenant, priority):
+            with cancellations.watch(req.load_id) as cancel:
+                entity = await process_service.process_file(req, cancel)
+    except SchedulerClosed:
+        raise NackMessage()
+    if process_service.transient_failures and await retries.schedule(req, tenant, attempt):
+        return
     await rmq_router.broker.publish(
-        message=entities,
+        message=LoadEvent(load_id=req.load_id, kind="file_done", gs_path=req.gs_path, result=entity),
         exchange=exchange,
-        routing_key="entity.store",
+        routing_key="process.load.file_done",
         headers={"tenant": tenant}
-    )
\ No newline at end of file
+    )
+
+
+@rmq_router.subscriber(queue=cancel_queue, exchange=exchange)
+async def cancel_load(req: CancelRequest):
+    if cancellations.cancel(req.load_id):
+        logger.info(f"Load {req.load_id} cancelled, stopping its files in progress")
+
+
+async def broadcast_cancel(load_id: uuid.UUID):
+    """
+    Sends the cancellation of a load to every instance, the files of the load may be anywhere
+    """
+    await rmq_router.broker.publish(
+        message=CancelRequest(load_id=load_id),
+        exchange=exchange,
+        routing_key="process.cancel",
+    )
+
+
+@rmq_router.subscriber(queue=loads_queue, exchange=exchange)
+async def aggregate_load(event: LoadEvent, tenant: str = Context("message.headers.tenant", default=None)):
+    load = aggregator.add(event, tenant)
+    if load is None:
+        return
+    await publisher.publish(list(load.results.values()), load.tenant)
+
+
+@rmq_router.subscriber(queue=ingest_queue, exchange=exchange)
+async def ingest(body: dict, bucket_service: Annotated[BucketService, Depends(get_bucket_service)],
+                 routing_key: str = Context("message.raw_message.routing_key"),
+                 tenant: str = Context("message.headers.tenant", default=None),
+                 priority: int | None = Context("message.raw_message.priority", default=None)):
+    """
+    Event driven loads: ingest.load.open (a process request) starts a load, every ingest.object.finalize
+    under its gs path is processed as a file of the load as soon as it is uploaded, ingest.load.close ends it
+    """
+    match routing_key:
+        case "ingest.load.open":
+            if not tenant:
+                logger.error("Message dont have tenant header, cannot proceed")
+                raise RejectMessage()
+            request = ProcessRequest.model_validate(body)
+            cancellations.forget(request.load_id)
+            for obj in ingestion.open(request, tenant, priority):
+                await ingest_object(obj, bucket_service)
+        case "ingest.object.finalize":
+            await ingest_object(ObjectFinalized.model_validate(body), bucket_service)
+        case "ingest.load.close":
+            load = ingestion.close(LoadClose.model_validate(body))
+            if load is not None:
+                await complete_ingestion(load)
+        case _:
+            logger.warning(f"Unknown ingestion event {routing_key}, ignoring")
+
+
+async def ingest_object(obj: ObjectFinalized, bucket_service: BucketService):
+    load = ingestion.add(obj)
+    if load is None:
+        return
+    if not obj.name.endswith(".zip"):
+        await route_file(load, obj.gs_path)
+        await complete_ingestion(load)
+        return
+    members = []
+    try:
+        blob = await bucket_service.get_blob(obj.gs_path)
+        # The members are uploaded next to the zip, their own notifications are ignored
+        members = [member.name for member in await bucket_service.flatten_zip(blob)] if blob else []
+    finally:
+        members = ingestion.zip_done(load, members)
+    for name in members:
+        await route_file(load, f"gs://{obj.bucket}/{name}")
+    await complete_ingestion(load)
+
+
+async def route_file(load: IngestingLoad, gs_path: str):
+    await rmq_router.broker.publish(
+        message=ProcessFileRequest(load_id=load.request.load_id, gs_path=gs_path, doc_type=load.request.doc_type),
+        exchange=exchange,
+        routing_key="process.file",
+        headers={"tenant": load.tenant},
+        priority=load.priority,
+    )
+
+
+async def complete_ingestion(load: IngestingLoad):
+    if not ingestion.complete(load):
+        return
+    logger.info(f"Ingestion of load {load.request.load_id} ended with {len(load.routed)} files")
+    await rmq_router.broker.publish(
+        message=LoadEvent(load_id=load.request.load_id, kind="listed", files=len(load.routed)),
+        exchange=exchange,
+        routing_key="process.load.listed",
+        headers={"tenant": load.tenant}
+    )
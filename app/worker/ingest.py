@@ -0,0 +1,122 @@
+import logging
+import time
+import uuid
+
+from pydantic import BaseModel
+
+from app.dto.ingest import ObjectFinalized, LoadClose
+from app.dto.process import ProcessRequest
+from app.services.bucket_service import is_processable, zip_base_path
+
+logger = logging.getLogger("uvicorn.error")
+ORPHAN_TTL = 600 # seconds a notification waits for the load of its prefix to be opened
+
+
+class IngestingLoad(BaseModel):
+    request: ProcessRequest
+    tenant: str
+    priority: int | None = None
+    uploads: int = 0 # objects of the upload notified, a zip is one
+    expected_uploads: int | None = None
+    closed: bool = False
+    pending_zips: int = 0
+    seen: set[str] = set()
+    zip_paths: set[str] = set() # where the members of its zips are extracted, their notifications are not uploads
+    routed: set[str] = set() # blobs sent to process.file
+
+    @property
+    def prefix(self) -> str:
+        return self.request.gs_path.rstrip("/") + "/"
+
+
+class IngestCoordinator:
+    """
+    Groups the object notifications of the bucket in the loads opened by the orchestrator, by prefix,
+    so every file is processed as soon as it is uploaded instead of when the whole upload ended.
+    A load is complete once the orchestrator closed it, every object it uploaded was notified and
+    its zips were flattened, then the aggregator is told how many files to wait for.
+    Notifications are delivered at least once and maybe before the load is opened, duplicates are
+    ignored and the early ones wait ORPHAN_TTL for their load.
+    The state is in memory, the ingest queue has a single active consumer
+    """
+
+    def __init__(self):
+        self.__loads: dict[uuid.UUID, IngestingLoad] = {}
+        self.__orphans: dict[str, tuple[ObjectFinalized, float]] = {}
+
+    def open(self, request: ProcessRequest, tenant: str, priority: int | None) -> list[ObjectFinalized]:
+        """
+        Opens the load, returns the notifications of its prefix that arrived before it
+        """
+        load = IngestingLoad(request=request, tenant=tenant, priority=priority)
+        self.__loads.setdefault(request.load_id, load)
+        claimed = [obj for path, (obj, _) in self.__orphans.items() if path.startswith(load.prefix)]
+        for obj in claimed:
+            del self.__orphans[obj.gs_path]
+        logger.info(f"Ingesting load {request.load_id} from {load.prefix}, {len(claimed)} files already uploaded")
+        return claimed
+
+    def close(self, event: LoadClose) -> IngestingLoad | None:
+        load = self.__loads.get(event.load_id)
+        if load is None:
+            logger.warning(f"Close of load {event.load_id} that is not being ingested, ignoring")
+            return None
+        load.closed = True
+        load.expected_uploads = event.files
+        return load
+
+    def add(self, obj: ObjectFinalized) -> IngestingLoad | None:
+        """
+        Registers the notification, returns its load when the object has to be processed:
+        a file is already counted in routed, a zip has to be flattened and ended with zip_done
+        """
+        self.__prune_orphans()
+        load = self.__find(obj.gs_path)
+        if load is None:
+            self.__orphans[obj.gs_path] = (obj, time.monotonic())
+            return None
+        name = obj.name
+        if name in load.seen or any(name.startswith(path) for path in load.zip_paths):
+            return None
+        load.seen.add(name)
+        load.uploads += 1
+        if not is_processable(name, load.prefix.split("/", 3)[3]):
+            return None
+        if name.endswith(".zip"):
+            load.zip_paths.add(zip_base_path(name) + "/")
+            load.pending_zips += 1
+        else:
+            load.routed.add(name)
+        return load
+
+    @staticmethod
+    def zip_done(load: IngestingLoad, members: list[str]) -> list[str]:
+        """
+        Ends a zip of the load, returns its members to be processed
+        """
+        load.pending_zips -= 1
+        members = [name for name in members if name not in load.routed]
+        load.routed.update(members)
+        return members
+
+    def complete(self, load: IngestingLoad) -> bool:
+        """
+        Tells if the load has every file routed, it is forgotten so it is completed only once
+        """
+        if load.request.load_id not in self.__loads or not load.closed or load.pending_zips:
+            return False
+        if load.expected_uploads is not None and load.uploads < load.expected_uploads:
+            return False
+        del self.__loads[load.request.load_id]
+        return True
+
+    def __find(self, gs_path: str) -> IngestingLoad | None:
+        loads = [load for load in self.__loads.values() if gs_path.startswith(load.prefix)]
+        return max(loads, key=lambda load: len(load.prefix), default=None)
+
+    def __prune_orphans(self):
+        now = time.monotonic()
+        for path, (_, received) in list(self.__orphans.items()):
+            if now - received > ORPHAN_TTL:
+                logger.warning(f"Notification of {path} didn't match any load, dropped")
+                del self.__orphans[path]
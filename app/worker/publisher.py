@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import uuid
+
+from faststream.rabbit import RabbitBroker, RabbitExchange
+
+from app.dependencies import RMQSettings
+from app.dto.entity_store import EntityStore
+
+logger = logging.getLogger("uvicorn.error")
+MAX_RETRY_DELAY = 30 # seconds
+
+
+class UnpublishedResults(Exception):
+    """
+    Results of a load that could not be published after every retry
+    """
+
+    def __init__(self, entities: list[EntityStore]):
+        super().__init__(f"{len(entities)} results could not be published")
+        self.entities = entities
+
+
+class ResultPublisher:
+    """
+    Publishes the results to entity.store. Streamed results are batched per tenant (the header
+    the orchestrator needs) and sent when the batch is full or its time window ends.
+    Submitting never waits for the broker: the batches are published in background tasks that
+    wait for the publisher confirms, at most rmq_publish_max_in_flight at the same time, and retry
+    with an exponential delay while the broker is not accepting them. The batches that still fail are
+    kept until their load flushes, so the load is not acked with results lost
+    """
+
+    def __init__(self, broker: RabbitBroker, exchange: RabbitExchange, config: RMQSettings):
+        self.__broker = broker
+        self.__exchange = exchange
+        self.__config = config
+        self.__in_flight: asyncio.Semaphore | None = None
+        self.__batches: dict[str, list[EntityStore]] = {}
+        self.__timers: dict[str, asyncio.TimerHandle] = {}
+        self.__tasks: dict[str, set[asyncio.Task]] = {}
+        self.__failed: dict[str, list[EntityStore]] = {}
+
+    def submit(self, entity: EntityStore, tenant: str):
+        batch = self.__batches.setdefault(tenant, [])
+        batch.append(entity)
+        if len(batch) >= self.__config.rmq_publish_batch_size:
+            self.__send(tenant)
+        elif tenant not in self.__timers:
+            self.__timers[tenant] = asyncio.get_running_loop().call_later(
+                self.__config.rmq_publish_batch_window, self.__send, tenant)
+
+    async def flush(self, tenant: str, load_id: uuid.UUID):
+        """
+        Sends the pending batch of the tenant and waits until everything submitted for it is confirmed,
+        raises UnpublishedResults with the results of the load that could not be published
+        """
+        self.__send(tenant)
+        tasks = self.__tasks.get(tenant)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        failed = self.__failed.pop(tenant, [])
+        unpublished = [entity for entity in failed if entity.load_id == load_id]
+        # The batches of a tenant mix its loads, the results of the other loads wait for their own flush
+        others = [entity for entity in failed if entity.load_id != load_id]
+        if others:
+            self.__failed[tenant] = others
+        if unpublished:
+            raise UnpublishedResults(unpublished)
+
+    async def publish(self, message: list[EntityStore] | None, tenant: str):
+        """
+        Publishes a message right away waiting for its confirm, with the same retries as the batches
+        """
+        if self.__in_flight is None:
+            self.__in_flight = asyncio.Semaphore(self.__config.rmq_publish_max_in_flight)
+        async with self.__in_flight:
+            for attempt in range(self.__config.rmq_publish_max_retries + 1):
+                try:
+                    await self.__broker.publish(
+                        message=message,
+                        exchange=self.__exchange,
+                        routing_key="entity.store",
+                        headers={"tenant": tenant}
+                    )
+                    return
+                except Exception as e:
+                    if attempt == self.__config.rmq_publish_max_retries:
+                        logger.exception(f"Unable to publish {len(message or [])} results of tenant {tenant}, giving up")
+                        raise e
+                    delay = min(2 ** attempt, MAX_RETRY_DELAY)
+                    logger.warning(f"Error publishing results of tenant {tenant}, retrying in {delay}s: {e}")
+                    await asyncio.sleep(delay)
+
+    def __send(self, tenant: str):
+        timer = self.__timers.pop(tenant, None)
+        if timer:
+            timer.cancel()
+        batch = self.__batches.pop(tenant, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self.__publish_batch(batch, tenant))
+        tasks = self.__tasks.setdefault(tenant, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def __publish_batch(self, batch: list[EntityStore], tenant: str):
+        try:
+            await self.publish(batch, tenant)
+        except Exception:
+            self.__failed.setdefault(tenant, []).extend(batch)
@@ -0,0 +1,60 @@
+import logging
+
+from faststream.rabbit import RabbitBroker, RabbitExchange, RabbitQueue
+
+from app.dependencies import RMQSettings
+from app.dto.process import ProcessFileRequest
+
+logger = logging.getLogger("uvicorn.error")
+DEAD_LETTER_QUEUE = "bloocheck.files.dead"
+
+
+class FileRetries:
+    """
+    Sends again the files that failed for a transient error. The file waits in a delay queue of its
+    attempt, that has no consumers: when the ttl of the queue ends rabbit dead letters the message
+    to process.file.retry. The delay doubles on every attempt, one queue per attempt because rabbit
+    only expires the messages at the head of a queue so they all need the same ttl.
+    A file failing after rmq_retry_max_attempts goes to the dead letter queue to be inspected
+    """
+
+    def __init__(self, broker: RabbitBroker, exchange: RabbitExchange, config: RMQSettings):
+        self.__broker = broker
+        self.__exchange = exchange
+        self.__config = config
+
+    def __delay_queue(self, attempt: int) -> RabbitQueue:
+        delay = self.__config.rmq_retry_base_delay * 2 ** attempt
+        return RabbitQueue(
+            f"bloocheck.files.delay.{attempt}",
+            durable=True,
+            arguments={
+                "x-message-ttl": int(delay * 1000),
+                "x-dead-letter-exchange": self.__exchange.name,
+                "x-dead-letter-routing-key": "process.file.retry",
+            },
+        )
+
+    async def declare(self):
+        """
+        The delay queues are not consumed so faststream doesn't declare them, done after the broker starts
+        """
+        for attempt in range(self.__config.rmq_retry_max_attempts):
+            await self.__broker.declare_queue(self.__delay_queue(attempt))
+        await self.__broker.declare_queue(RabbitQueue(DEAD_LETTER_QUEUE, durable=True))
+
+    async def schedule(self, req: ProcessFileRequest, tenant: str, attempt: int) -> bool:
+        """
+        Sends the file to the delay queue of its attempt, returns False when it has no attempts
+        left and it was sent to the dead letter queue instead
+        """
+        headers = {"tenant": tenant, "attempt": attempt + 1}
+        if attempt >= self.__config.rmq_retry_max_attempts:
+            logger.error(f"File {req.gs_path} of load {req.load_id} failed after {attempt} retries, sent to {DEAD_LETTER_QUEUE}")
+            await self.__broker.publish(message=req, queue=DEAD_LETTER_QUEUE, headers=headers, persist=True)
+            return False
+        queue = self.__delay_queue(attempt)
+        logger.warning(f"File {req.gs_path} of load {req.load_id} failed with a transient error, retry {attempt + 1} in {queue.arguments['x-message-ttl'] / 1000}s")
+        # Published to the default exchange, it routes by queue name so the delay queues need no binding
+        await self.__broker.publish(message=req, queue=queue, headers=headers, persist=True)
+        return True
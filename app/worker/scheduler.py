@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+from app.dependencies import RMQSettings
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class SchedulerClosed(Exception):
+    """
+    The worker is draining, the message has to go back to the queue for another instance
+    """
+
+
+class TenantScheduler:
+    """
+    Decides which of the consumed messages runs next. The prefetch lets the worker hold messages of
+    several tenants, this grants them rmq_max_tasks slots at most: the highest priority waiting goes
+    first, and between the tenants with that priority the slots go round robin, each tenant taking
+    as many in a row as its weight. A tenant never runs more than rmq_tenant_max_tasks at the same
+    time, so a big load can't take the whole worker while other tenants wait
+    """
+
+    def __init__(self, config: RMQSettings):
+        self.__config = config
+        self.__running = 0
+        self.__running_by_tenant: dict[str, int] = {}
+        self.__waiting: dict[str, list[tuple[int, int, asyncio.Future]]] = {} # heap of (-priority, arrival, future)
+        self.__ring: deque[str] = deque() # tenants with messages waiting, in round robin order
+        self.__credits: dict[str, int] = {}
+        self.__arrivals = itertools.count()
+        self.__closed = False
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, priority: int = 0):
+        """
+        Waits for a slot of the tenant and holds it while the message is processed
+        """
+        if self.__closed:
+            raise SchedulerClosed()
+        future = asyncio.get_running_loop().create_future()
+        if tenant not in self.__waiting:
+            self.__waiting[tenant] = []
+            self.__ring.append(tenant)
+            self.__credits[tenant] = self.__weight(tenant)
+        heapq.heappush(self.__waiting[tenant], (-priority, next(self.__arrivals), future))
+        self.__dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.__release(tenant)
+            else:
+                self.__forget(tenant, future)
+            raise
+        try:
+            yield
+        finally:
+            self.__release(tenant)
+
+    def close(self):
+        """
+        No more slots are granted, the messages waiting for one are given back
+        """
+        self.__closed = True
+        waiting = sum(len(entries) for entries in self.__waiting.values())
+        if waiting:
+            logger.info(f"Scheduler closed, {waiting} messages waiting are returned to the queue")
+        for tenant, entries in list(self.__waiting.items()):
+            for _, _, future in entries:
+                future.set_exception(SchedulerClosed())
+            self.__drop(tenant)
+
+    def __weight(self, tenant: str) -> int:
+        return max(self.__config.rmq_tenant_weights.get(tenant, 1), 1)
+
+    def __release(self, tenant: str):
+        self.__running -= 1
+        self.__running_by_tenant[tenant] -= 1
+        if not self.__running_by_tenant[tenant]:
+            del self.__running_by_tenant[tenant]
+        self.__dispatch()
+
+    def __forget(self, tenant: str, future: asyncio.Future):
+        waiting = self.__waiting.get(tenant)
+        if waiting is None:
+            return
+        waiting[:] = [entry for entry in waiting if entry[2] is not future]
+        heapq.heapify(waiting)
+        if not waiting:
+            self.__drop(tenant)
+        self.__dispatch()
+
+    def __drop(self, tenant: str):
+        del self.__waiting[tenant]
+        del self.__credits[tenant]
+        self.__ring.remove(tenant)
+
+    def __eligible(self, tenant: str) -> bool:
+        return self.__running_by_tenant.get(tenant, 0) < self.__config.rmq_tenant_max_tasks
+
+    def __dispatch(self):
+        while self.__running < self.__config.rmq_max_tasks:
+            tenant = self.__next_tenant()
+            if tenant is None:
+                return
+            _, _, future = heapq.heappop(self.__waiting[tenant])
+            if not self.__waiting[tenant]:
+                self.__drop(tenant)
+            if future.done():
+                # Its waiter was cancelled before the slot got to it, so it is not counted as running and the tenant keeps its turn
+                if tenant in self.__credits:
+                    self.__credits[tenant] += 1
+                continue
+            self.__running += 1
+            self.__running_by_tenant[tenant] = self.__running_by_tenant.get(tenant, 0) + 1
+            future.set_result(None)
+
+    def __next_tenant(self) -> str | None:
+        eligible = [tenant for tenant in self.__ring if self.__eligible(tenant)]
+        if not eligible:
+            return None
+        # Priorities go first across the tenants, the round robin is only between the ones with the top priority
+        top = min(self.__waiting[tenant][0][0] for tenant in eligible)
+        for _ in range(len(self.__ring)):
+            tenant = self.__ring[0]
+            if self.__eligible(tenant) and self.__waiting[tenant][0][0] == top and self.__credits[tenant] > 0:
+                self.__credits[tenant] -= 1
+                return tenant
+            self.__credits[tenant] = self.__weight(tenant)
+            self.__ring.rotate(-1)
+        # Every candidate had spent its credits in this round, they are refilled already
+        tenant = next(tenant for tenant in self.__ring if self.__eligible(tenant) and self.__waiting[tenant][0][0] == top)
+        self.__credits[tenant] -= 1
+        return tenant
@@ -0,0 +1,58 @@
+"""
+Per request latency of a gemini call like the ones made by /api/v1/extract, building a new
+genai client for every request (how get_model_service worked before) against reusing the
+process wide client from app.dependencies. The difference is what each request saves.
+
+Needs the same environment as the app (.env with project_id and region, and default credentials):
+
+    uv run python -m benchmarks.genai_client_reuse --requests 20
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from google import genai
+
+from app.dependencies import get_settings, get_genai_client, close_genai_client
+from app.services.model_service import GEMINI_MODEL
+
+PROMPT = "Responde únicamente con la palabra OK"
+
+
+async def _timed_calls(get_client, requests: int) -> list[float]:
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client = get_client()
+        await client.aio.models.generate_content(model=GEMINI_MODEL, contents=[PROMPT])
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _report(name: str, timings: list[float]):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<14} mean={statistics.mean(timings) * 1000:8.1f}ms  "
+          f"p50={statistics.median(timings) * 1000:8.1f}ms  p95={p95 * 1000:8.1f}ms")
+
+
+async def main(requests: int):
+    settings = get_settings()
+    new_client = lambda: genai.Client(vertexai=True, project=settings.project_id, location=settings.region)
+    per_request = await _timed_calls(new_client, requests)
+    # first call warms up the shared client, as the lifespan does
+    await _timed_calls(get_genai_client, 1)
+    shared = await _timed_calls(get_genai_client, requests)
+    await close_genai_client()
+
+    _report("client/request", per_request)
+    _report("shared client", shared)
+    saved = statistics.mean(per_request) - statistics.mean(shared)
+    print(f"saved per request: {saved * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20)
+    asyncio.run(main(parser.parse_args().requests))
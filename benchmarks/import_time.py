@@ -0,0 +1,54 @@
+"""
+Import time gate. Each module is imported in a fresh interpreter, its import time is reported
+and the run fails if it pulls a module it must not (the document configuration is read by every
+worker and must stay light, pandas is only loaded when a document is extracted) or if it goes
+over the --max-seconds budget.
+
+    uv run python -m benchmarks.import_time --max-seconds 3
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# module => modules that must not be loaded by importing it
+GATES = {
+    "analyzers.document_config": ["pandas", "numpy", "google"],
+    "app.main": ["pandas", "numpy", "analyzers.analyzer"],
+}
+
+_MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": list(sys.modules)}}))
+"""
+
+
+def _measure(module: str) -> dict:
+    out = subprocess.run([sys.executable, "-c", _MEASURE.format(module=module)],
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(max_seconds: float | None):
+    failed = False
+    for module, forbidden in GATES.items():
+        result = _measure(module)
+        pulled = sorted({f for f in forbidden for m in result["modules"] if m == f or m.startswith(f + ".")})
+        print(f"{module:<28} {result['seconds'] * 1000:8.1f}ms  {len(result['modules'])} modules loaded")
+        if pulled:
+            print(f"  pulls {', '.join(pulled)}")
+            failed = True
+        if max_seconds is not None and result["seconds"] > max_seconds:
+            print(f"  over the budget of {max_seconds:.2f}s")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-seconds", type=float, default=None)
+    main(parser.parse_args().max_seconds)
@@ -0,0 +1,49 @@
+"""
+Time to first ready of a new instance: importing the app and running the lifespan warm up,
+each run in a fresh interpreter like a cold Cloud Run instance. With --max-seconds it exits
+with an error when the slowest run goes over the budget, so it can gate regressions.
+
+Needs the same environment as the app (.env and default credentials), without credentials
+the warm up steps fail fast and only the import time is meaningful:
+
+    uv run python -m benchmarks.startup --runs 3 --max-seconds 10
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+_MEASURE = """
+import asyncio, json, time
+start = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+from app.utils.warmup import warm_up
+asyncio.run(warm_up())
+ready = time.perf_counter()
+print(json.dumps({"import": imported - start, "warm_up": ready - imported, "ready": ready - start}))
+"""
+
+
+def _run_once() -> dict[str, float]:
+    out = subprocess.run([sys.executable, "-c", _MEASURE], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(runs: int, max_seconds: float | None):
+    results = [_run_once() for _ in range(runs)]
+    for i, r in enumerate(results):
+        print(f"run {i + 1}: import={r['import']:.2f}s  warm_up={r['warm_up']:.2f}s  ready={r['ready']:.2f}s")
+    slowest = max(r["ready"] for r in results)
+    print(f"time to first ready (slowest): {slowest:.2f}s")
+    if max_seconds is not None and slowest > max_seconds:
+        print(f"over the budget of {max_seconds:.2f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=None)
+    args = parser.parse_args()
+    main(args.runs, args.max_seconds)
@@ -0,0 +1,71 @@
+import asyncio
+
+from app.dependencies import RMQSettings
+from app.worker.scheduler import TenantScheduler
+
+
+def settings(**values) -> RMQSettings:
+    return RMQSettings.model_construct(**{"rmq_max_tasks": 1, "rmq_tenant_max_tasks": 1, "rmq_tenant_weights": {}, **values})
+
+
+async def hold(scheduler: TenantScheduler, tenant: str, started: list[str], release: asyncio.Event):
+    async with scheduler.slot(tenant):
+        started.append(tenant)
+        await release.wait()
+
+
+def test_cancel_then_release_gives_the_slot_to_the_next_waiter():
+    async def scenario():
+        scheduler = TenantScheduler(settings())
+        started = []
+        cancelled, queued = None, asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("a"):
+                started.append("a")
+                await queued.wait()
+                # The waiter is cancelled right before the slot is released, it hasn't resumed to leave the queue yet
+                cancelled.cancel()
+
+        task = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(hold(scheduler, "b", started, asyncio.Event()))
+        release = asyncio.Event()
+        release.set()
+        waiter = asyncio.create_task(hold(scheduler, "c", started, release))
+        await asyncio.sleep(0)
+        queued.set()
+        await task
+        await asyncio.wait_for(waiter, 1)
+        assert started == ["a", "c"]
+        assert cancelled.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_its_slot_free():
+    async def scenario():
+        scheduler = TenantScheduler(settings())
+        started = []
+        cancelled, queued = None, asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("a"):
+                started.append("a")
+                await queued.wait()
+                cancelled.cancel()
+
+        task = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(hold(scheduler, "b", started, asyncio.Event()))
+        await asyncio.sleep(0)
+        queued.set()
+        await task
+        # Nothing is running, a new message gets the slot right away
+        release = asyncio.Event()
+        release.set()
+        await asyncio.wait_for(hold(scheduler, "c", started, release), 1)
+        assert started == ["a", "c"]
+        assert cancelled.cancelled()
+
+    asyncio.run(scenario())